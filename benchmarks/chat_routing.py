@@ -0,0 +1,87 @@
+
+"""Measure how many chat lines per second a bot with all bundled features enabled can take through recv_chat(),
+compared to the previous approach of passing every line to every feature.
+
+Lines are typical chat that no command acts on (so no pip data is needed), with some mentions of
+"pippy" and unknown commands mixed in.
+
+Usage, from the repository root: PYTHONPATH=. python benchmarks/chat_routing.py [LINES]
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import logging
+import socket
+import sys
+import time
+
+import gevent
+
+from classtricks import get_all_subclasses
+
+from pipirc.bot import PippyBot
+from pipirc.feature import Feature
+from pipirc.stream import Stream
+import pipirc.features # registers the bundled features
+
+
+class FakeServiceConfig(object):
+	default_irc_user = 'Mister_Pippy'
+	default_irc_oauth = 'oauth:notarealtoken'
+	pip_dispatch_window = 0.05
+	pip_dispatch_max_rate = 10
+
+
+class FakeIPC(object):
+	def send_chat(self, stream, text, priority='reply'):
+		pass
+
+	def close_stream(self, stream):
+		pass
+
+
+def lines(count):
+	for i in range(count):
+		if i % 20 == 0:
+			yield u'!notacommand {}'.format(i)
+		elif i % 20 == 1:
+			yield u'hey pippy what are you carrying'
+		else:
+			yield u'Kappa that was a great shot {}'.format(i)
+
+
+def fan_out(bot, text, sender, sender_rank):
+	"""The previous approach, where every message callback got every line and commands parsed it themselves"""
+	for feature in bot.features:
+		for callback in feature._message_callbacks:
+			feature.group.spawn(feature._log_errors, callback, text, sender, sender_rank)
+
+
+def bench(name, bot, fn, texts):
+	start = time.time()
+	for text in texts:
+		fn(text, u'someviewer', 'viewer')
+	gevent.joinall([gevent.spawn(feature.group.join) for feature in bot.features])
+	elapsed = time.time() - start
+	print "{:<10} {:>12.1f} lines/s".format(name, len(texts) / elapsed)
+
+
+def main(count=100000):
+	logging.basicConfig(level=logging.WARNING)
+	texts = list(lines(int(count)))
+	stream_config = Stream('somestreamer', dict(
+		pip_key='x' * 32,
+		**{feature.name: {'enabled': True} for feature in get_all_subclasses(Feature)}
+	), FakeServiceConfig())
+	pip_sock, _ = socket.socketpair()
+	bot = PippyBot(FakeIPC(), pip_sock, stream_config.name, stream_config)
+
+	print "{} lines, {} features".format(len(texts), len(bot.features))
+	bench("fan out", bot, lambda *args: fan_out(bot, *args), texts)
+	bench("routed", bot, bot.recv_chat, texts)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
+
@@ -0,0 +1,65 @@
+
+
+"""Compare IPC codecs by how many typical chat messages per second each can encode then decode,
+both sent individually and in 'batch' frames of BATCH_SIZE messages (as MessageBatcher sends them
+with the default ipc_batch_size).
+
+Usage, from the repository root: PYTHONPATH=. python benchmarks/ipc_codec.py [COUNT] [BATCH_SIZE]
+"""
+
+import sys
+import time
+
+from pipirc.codec import CODECS
+
+
+def messages(count):
+	for i in range(count):
+		if i % 2:
+			# master to worker
+			yield {
+				'type': 'chat message', 'stream': 'somestreamer', 'text': u'!use {} PogChamp'.format(i % 12),
+				'sender': u'SomeViewer{}'.format(i % 1000), 'sender_rank': 'viewer',
+			}
+		else:
+			# worker to master
+			yield {'type': 'chat message', 'stream': 'somestreamer', 'text': u'Equipped Fat Man...indoors.'}
+
+
+def batches(msgs, batch_size):
+	for i in range(0, len(msgs), batch_size):
+		yield {'type': 'batch', 'messages': msgs[i:i + batch_size]}
+
+
+def bench(codec, frames, count):
+	"""Returns (encode msg/s, decode msg/s, bytes/msg) for a list of frames containing count messages in total"""
+	start = time.time()
+	buf = ''.join(codec.encode(frame) for frame in frames)
+	encoded = time.time()
+	pos = 0
+	decoded = 0
+	while pos < len(buf):
+		msg, pos = codec.decode(buf, pos)
+		decoded += len(msg['messages']) if msg['type'] == 'batch' else 1
+	end = time.time()
+	assert decoded == count
+	return count / (encoded - start), count / (end - encoded), len(buf) / float(count)
+
+
+def main(count=200000, batch_size=64):
+	msgs = list(messages(int(count)))
+	framings = [
+		('single', msgs),
+		('batch', list(batches(msgs, int(batch_size)))),
+	]
+	print "{} messages, batches of {}".format(len(msgs), batch_size)
+	print "{:<8} {:<8} {:>14} {:>14} {:>12}".format('codec', 'frames', 'encode msg/s', 'decode msg/s', 'bytes/msg')
+	for framing, frames in framings:
+		for name, codec in sorted(CODECS.items()):
+			encode_rate, decode_rate, size = bench(codec, frames, len(msgs))
+			print "{:<8} {:<8} {:>14.0f} {:>14.0f} {:>12.1f}".format(name, framing, encode_rate, decode_rate, size)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
+
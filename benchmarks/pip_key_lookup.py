@@ -0,0 +1,65 @@
+
+"""Compare the time to look up a stream by pip key with the HMAC index vs comparing against every stream's key,
+for both a matching key and a junk key (eg. from a port scanner).
+
+Usage, from the repository root: PYTHONPATH=. python benchmarks/pip_key_lookup.py [STREAMS] [LOOKUPS]
+"""
+
+from random import SystemRandom
+import string
+import sys
+import time
+
+from pipirc.pipkey import PipKeyIndex, constant_time_equal
+
+
+class FakeStream(object):
+	def __init__(self, pip_key):
+		self.pip_key = pip_key
+
+
+def gen_key(random):
+	# as per Stream.gen_pip_key(), which we can't import without the worker's dependencies
+	corpus = string.letters + string.digits
+	return ''.join(random.choice(corpus) for i in range(32))
+
+
+def linear_lookup(streams, pip_key):
+	"""The previous implementation"""
+	matches = [stream for stream in streams if constant_time_equal(stream.pip_key, pip_key)]
+	return matches[0] if matches else None
+
+
+def bench(name, fn, keys):
+	start = time.time()
+	for key in keys:
+		fn(key)
+	elapsed = time.time() - start
+	print "{:<20} {:>12.1f} lookups/s {:>10.3f} ms/lookup".format(name, len(keys) / elapsed, 1000 * elapsed / len(keys))
+
+
+def main(num_streams=10000, lookups=1000):
+	num_streams = int(num_streams)
+	lookups = int(lookups)
+	random = SystemRandom()
+	streams = [FakeStream(gen_key(random)) for i in range(num_streams)]
+	index = PipKeyIndex(streams)
+
+	good_keys = [random.choice(streams).pip_key for i in range(lookups)]
+	junk_keys = [gen_key(random) for i in range(lookups)]
+
+	for keys in (good_keys, junk_keys):
+		assert all((index.get(key) is linear_lookup(streams, key)) for key in keys[:10])
+
+	print "{} streams".format(num_streams)
+	# the linear lookup is slow enough that fewer lookups give an accurate figure
+	linear_lookups = max(1, lookups / 100)
+	bench("linear, match", lambda key: linear_lookup(streams, key), good_keys[:linear_lookups])
+	bench("linear, junk", lambda key: linear_lookup(streams, key), junk_keys[:linear_lookups])
+	bench("index, match", index.get, good_keys)
+	bench("index, junk", index.get, junk_keys)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
+
@@ -0,0 +1,68 @@
+
+"""Compare the cost of the pip update loop when Player and Inventory views are made on every access
+(as PippyBot used to) vs reused from a ViewCache until the next update.
+
+Each simulated update does what the bot does while a command waits on the use item lock
+(UseItemLock.check() reads inventory.version and player.locked), then ACCESSES more reads of each view,
+as a command like !use does while the lock is held.
+
+PIPDATA_PATH is a file containing a pickled mrpippy PipData, base64 encoded as in the 'pipdata'
+of a bot's get_state() (eg. a checkpoint).
+
+Usage, from the repository root: PYTHONPATH=. python benchmarks/pip_views.py PIPDATA_PATH [UPDATES] [ACCESSES]
+"""
+
+import base64
+import pickle
+import sys
+import time
+
+from mrpippy.data import Inventory, Player
+
+from pipirc.bot import ViewCache
+
+
+def uncached_loop(pipdata, updates, accesses):
+	for version in range(updates):
+		Inventory(pipdata).version
+		Player(pipdata).locked
+		for i in range(accesses):
+			Inventory(pipdata).version
+			Player(pipdata).value
+
+
+def cached_loop(pipdata, updates, accesses):
+	views = ViewCache()
+	for version in range(updates):
+		views.invalidate()
+		views.get(Inventory, pipdata, version).version
+		views.get(Player, pipdata, version).locked
+		for i in range(accesses):
+			views.get(Inventory, pipdata, version).version
+			views.get(Player, pipdata, version).value
+	return views
+
+
+def bench(name, fn, *args):
+	start = time.time()
+	result = fn(*args)
+	elapsed = time.time() - start
+	print "{:<10} {:>12.1f} updates/s {:>10.3f} ms/update".format(name, args[1] / elapsed, 1000 * elapsed / args[1])
+	return result
+
+
+def main(pipdata_path, updates=10000, accesses=4):
+	updates = int(updates)
+	accesses = int(accesses)
+	with open(pipdata_path) as f:
+		pipdata = pickle.loads(base64.b64decode(f.read()))
+
+	print "{} updates, {} extra accesses per update".format(updates, accesses)
+	bench("uncached", uncached_loop, pipdata, updates, accesses)
+	views = bench("cached", cached_loop, pipdata, updates, accesses)
+	print "cache hits: {}, misses: {}".format(views.hits, views.misses)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
+
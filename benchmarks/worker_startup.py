@@ -0,0 +1,86 @@
+
+"""Compare how long it takes for a new worker to be ready (connected to the master and sent its init message),
+when started as a fresh python process vs forked from a zygote, with and without a spare.
+
+Usage, from the repository root: PYTHONPATH=. python benchmarks/worker_startup.py CONFIG_PATH [COUNT]
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all(subprocess=True)
+
+from socket import AF_UNIX, SOCK_STREAM
+from uuid import uuid4
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from pipirc.zygote import Zygote
+
+
+def wait_for_worker(listener):
+	"""Accept a worker connection and wait for its init message, then close it so the worker exits"""
+	sock, addr = listener.accept()
+	buf = ''
+	while '\n' not in buf:
+		data = sock.recv(4096)
+		if not data:
+			raise Exception("Worker closed connection before init")
+		buf += data
+	sock.close()
+
+
+def bench_subprocess(conf_path, sock_path, listener, count):
+	times = []
+	for i in range(count):
+		start = time.time()
+		proc = subprocess.Popen([sys.executable, '-m', 'pipirc.worker', conf_path, sock_path])
+		wait_for_worker(listener)
+		times.append(time.time() - start)
+		proc.wait()
+	return times
+
+
+def bench_zygote(conf_path, sock_path, listener, count, spares):
+	zygote = Zygote(conf_path, sock_path, spares)
+	try:
+		# let the zygote finish loading and fork its spares
+		gevent.sleep(5)
+		times = []
+		for i in range(count):
+			start = time.time()
+			pid = zygote.spawn()
+			wait_for_worker(listener)
+			times.append(time.time() - start)
+			zygote.wait(pid)
+			gevent.sleep(0.5) # let spare be replaced
+		return times
+	finally:
+		zygote.stop()
+
+
+def main(conf_path, count=10):
+	count = int(count)
+	sock_path = '/tmp/{}.sock'.format(uuid4())
+	listener = socket.socket(AF_UNIX, SOCK_STREAM)
+	listener.bind(sock_path)
+	listener.listen(128)
+	try:
+		results = [
+			('subprocess', bench_subprocess(conf_path, sock_path, listener, count)),
+			('zygote', bench_zygote(conf_path, sock_path, listener, count, 0)),
+			('zygote+spare', bench_zygote(conf_path, sock_path, listener, count, 1)),
+		]
+	finally:
+		os.remove(sock_path)
+	print "{:<14} {:>10} {:>10} {:>10}".format('mode', 'min ms', 'mean ms', 'max ms')
+	for name, times in results:
+		print "{:<14} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+			name, 1000 * min(times), 1000 * sum(times) / len(times), 1000 * max(times),
+		)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
+
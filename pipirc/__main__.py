@@ -2,12 +2,26 @@
 import gevent.monkey
 gevent.monkey.patch_all(subprocess=True)
 
-from gtools import backdoor
-backdoor(2201)
-
+import socket
 import sys
 
-from .main import main
+from gtools import backdoor
+
+# Processes the master starts (other than workers, see pipirc.worker) are also run from here,
+# so that they are patched before anything else is imported.
+if sys.argv[1:2] == ['zygote']:
+	from .zygote import main
+	args = sys.argv[2:]
+elif sys.argv[1:2] == ['gateway']:
+	from .gateway import main
+	args = sys.argv[2:]
+else:
+	try:
+		backdoor(2201)
+	except socket.error:
+		pass # eg. a master we're taking over from still holds the port
+	from .main import main
+	args = sys.argv[1:]
 
-ret = main(*sys.argv[1:])
+ret = main(*args)
 sys.exit(ret)
@@ -1,4 +1,11 @@
 
+from socket import AF_INET, SOCK_STREAM
+import base64
+import pickle
+import re
+import socket
+import time
+
 import gevent.event
 
 from classtricks import HasLogger, get_all_subclasses
@@ -6,25 +13,106 @@ from mrpippy.data import Inventory, Player
 import deepclient
 import gpippy
 
+from .chatfilter import ChatFilter
 from .feature import Feature, UserError
+from .inventory import InventoryIndex
+from .pipsocket import PipSocket
+from .subscriptions import UpdateSubscriptions
+
+
+def coalesce_lines(lines, separator, max_bytes):
+	"""Join lines with separator into as few messages as possible, each no more than max_bytes when utf-8 encoded.
+	Lines which are already too long are left as their own message."""
+	def byte_len(s):
+		return len(s.encode('utf-8')) if isinstance(s, unicode) else len(s)
+	messages = []
+	for line in lines:
+		if messages and byte_len(messages[-1]) + byte_len(separator) + byte_len(line) <= max_bytes:
+			messages[-1] += separator + line
+		else:
+			messages.append(line)
+	return messages
+
+
+class ViewCache(object):
+	"""Holds wrappers around pip data (eg. mrpippy.data.Player) so they can be reused until the data changes.
+	Each view is kept along with the data version it was made at, and only returned for that version."""
+
+	def __init__(self):
+		self._views = {} # {cls: (version, view)}
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, cls, pipdata, version):
+		"""Returns cls(pipdata), reusing the last one made at the same version"""
+		cached = self._views.get(cls)
+		if cached is not None and cached[0] == version:
+			self.hits += 1
+			return cached[1]
+		self.misses += 1
+		view = cls(pipdata)
+		self._views[cls] = version, view
+		return view
+
+	def invalidate(self):
+		self._views.clear()
 
 
 class PippyBot(HasLogger):
-	def __init__(self, ipc, pip_sock, stream_name, stream_config, logger=None):
+	pip_updates = 0 # count of pip update batches recieved
+	checkpointed = False # whether the master holds our current state, see IPCWorkerConnection._checkpoint_loop()
+	update_callbacks_called = 0 # count of feature update callbacks run
+	update_callbacks_skipped = 0 # count of feature update callbacks not run as nothing they subscribe to changed
+	pip_dispatches = 0 # count of times pip updates were passed on to features, see _dispatch_loop()
+	max_merged_batches = 0 # most pip update batches merged into one dispatch
+	quiesced = False
+
+	COALESCE_WINDOW = 0.2 # how long to wait for more lines of output to coalesce, see say()
+	COALESCE_SEPARATOR = ' | '
+	MAX_MESSAGE_BYTES = 500 # twitch's limit for one chat message
+
+	def __init__(self, ipc, pip_sock, stream_name, stream_config, state=None, logger=None):
+		"""If state is given, resume a stream that was quiesced in another process. See quiesce()."""
 		super(PippyBot, self).__init__(logger=logger)
 		self.ipc = ipc
 		self.stream_name = stream_name
 		self.config = stream_config
+		self._pip_sock = pip_sock
+		self._pip_socket = None # PipSocket that the pip client reads from
 
 		self._data_ready = gevent.event.Event()
 		self.use_item_lock = UseItemLock(self)
+		self._quiesce_waiter = None
+		self._reader_released = gevent.event.Event()
+		self._say_buffer = [] # lines waiting to be coalesced
+		self._say_priority = None # priority of lines in _say_buffer
+		self._say_flusher = None
+		self._views = ViewCache()
+		self._pending_updates = [] # updated values not yet dispatched
+		self._pending_ids = set() # ids of values in _pending_updates, so a value updated again isn't repeated
+		self._pending_batches = 0 # number of update batches they came from
+		self._dispatcher = None
+		self._last_dispatch = None
+		self.inventory_index = InventoryIndex(self)
 
 		self.debug("Starting...")
 		self._init_features()
 
-		self._pippy = gevent.spawn(
-			self._stop_on_fail, gpippy.Client, host=None, sock=pip_sock, on_update=self.on_pip_update, on_close=lambda ex: self.stop()
-		)
+		pipdata = None
+		unread = ''
+		if state is not None:
+			self.use_item_lock.set_last_use_version(state['last_use_version'])
+			for feature in self.features:
+				if feature.name in state['features']:
+					feature.set_state(state['features'][feature.name])
+			pipdata = pickle.loads(base64.b64decode(state['pipdata']))
+			unread = base64.b64decode(state.get('unread', ''))
+
+		self._pip_socket = PipSocket(pip_sock, unread)
+		if state is not None:
+			# the master keeps the state we were resumed from as our checkpoint
+			self.mark_checkpointed()
+		self._pippy = gevent.spawn(self._stop_on_fail, self._start_pippy, self._pip_socket, pipdata)
 		if self.config.deepbot_url:
 			self._deepbot = gevent.spawn(
 				deepclient.DeepClient, self.config.deepbot_url, self.config.deepbot_secret
@@ -34,6 +122,19 @@ class PippyBot(HasLogger):
 
 		self.debug("Started")
 
+	def _start_pippy(self, pip_sock, pipdata=None):
+		client = gpippy.Client(host=None, sock=pip_sock, on_update=self.on_pip_update, on_close=self._on_pip_close)
+		if pipdata is not None:
+			# we're resuming a connection part-way through, so the initial data dump won't be sent again.
+			# this is safe as long as the client hasn't processed any messages yet, ie. we haven't yielded.
+			client.pipdata = pipdata
+			self._data_ready.set()
+		return client
+
+	def _on_pip_close(self, ex):
+		if not self.quiesced:
+			self.stop()
+
 	def _stop_on_fail(self, fn, *args, **kwargs):
 		try:
 			return fn(*args, **kwargs)
@@ -53,32 +154,209 @@ class PippyBot(HasLogger):
 				continue
 			self.logger.debug("Registering feature {}".format(feature.name))
 			self.features.append(feature(self, feature_config))
+		self._update_subscriptions = UpdateSubscriptions()
+		for feature in self.features:
+			for callback in feature._update_callbacks:
+				self._update_subscriptions.add((feature, callback), callback._update_paths)
+		self._compile_chat_routes()
+
+	def _compile_chat_routes(self):
+		"""Build the table recv_chat() uses to find which of our features' callbacks a message is for"""
+		self._command_routes = {} # {command with prefix: [(feature, BoundCommand)]}
+		self._message_handlers = [] # [(feature, callback, compiled pattern or None to match everything)]
+		for feature in self.features:
+			commands, handlers = feature.get_chat_routes()
+			for prefix, command in commands:
+				self._command_routes.setdefault(prefix, []).append((feature, command))
+			for callback, pattern in handlers:
+				if pattern is not None:
+					try:
+						pattern = re.compile(pattern)
+					except re.error:
+						self.logger.warning("Bad message pattern {!r} for {}, passing it all chat".format(pattern, callback))
+						pattern = None
+				self._message_handlers.append((feature, callback, pattern))
 
 	def recv_chat(self, text, sender, sender_rank):
 		self.logger.debug("Got chat message from {}({}): {!r}".format(sender, sender_rank, text))
+		args = text.split()
+		if args:
+			for feature, command in self._command_routes.get(args[0], ()):
+				feature.group.spawn(feature._log_errors, command.run, args[1:], text, sender, sender_rank)
+		for feature, callback, pattern in self._message_handlers:
+			if pattern is None or pattern.search(text):
+				feature.group.spawn(feature._log_errors, callback, text, sender, sender_rank)
+
+	def get_chat_filter(self):
+		"""Returns a ChatFilter description (see pipirc.chatfilter) matching any message our features might act on"""
+		commands = set()
+		patterns = []
+		match_all = False
 		for feature in self.features:
-			feature.recv_chat(text, sender, sender_rank)
+			feature_commands, feature_patterns, feature_match_all = feature.get_chat_filter()
+			commands |= feature_commands
+			patterns += feature_patterns
+			match_all = match_all or feature_match_all
+		return ChatFilter(commands, patterns, match_all).describe()
 
 	def on_pip_update(self, updates):
+		self.pip_updates += 1
+		self._views.invalidate()
 
 		# unblock things waiting for data
 		if self.pippy.pipdata.root is not None:
 			self._data_ready.set()
 
+		# hand the rest to the dispatcher, merging with any updates it hasn't got to yet
+		for value in updates:
+			if id(value) not in self._pending_ids:
+				self._pending_ids.add(id(value))
+				self._pending_updates.append(value)
+		self._pending_batches += 1
+		if not self._dispatcher:
+			self._dispatcher = gevent.spawn(self._dispatch_loop)
+
+		# we're in the pip client's read loop between messages, one of the places it's safe to stop reading
+		if self._quiesce_waiter and not self._quiesce_waiter.ready():
+			self._quiesce_waiter.set()
+			self._reader_released.wait() # stop reading until we have closed the client
+
+	def _dispatch_loop(self):
+		"""Pass pending pip updates on, waiting pip_dispatch_window for more to arrive first
+		and no more often than pip_dispatch_max_rate. Exits once there's nothing pending."""
+		service_config = self.config.config
+		try:
+			while self._pending_batches:
+				delay = service_config.pip_dispatch_window
+				if service_config.pip_dispatch_max_rate and self._last_dispatch is not None:
+					next_allowed = self._last_dispatch + 1. / service_config.pip_dispatch_max_rate
+					delay = max(delay, next_allowed - time.time())
+				if delay > 0:
+					gevent.sleep(delay)
+				self._last_dispatch = time.time()
+				self._flush_updates()
+		finally:
+			self._dispatcher = None
+
+	def _flush_updates(self):
+		updates, self._pending_updates = self._pending_updates, []
+		self._pending_ids = set()
+		batches, self._pending_batches = self._pending_batches, 0
+		if not batches:
+			return
+		self.pip_dispatches += 1
+		self.max_merged_batches = max(self.max_merged_batches, batches)
+		self._dispatch_updates(updates)
+
+	def _dispatch_updates(self, updates):
 		# unblock things waiting for items to be usable
 		self.use_item_lock.check()
 
-		# call feature callbacks
+		# call feature callbacks that care about what changed
+		try:
+			matched = self._update_subscriptions.match(updates)
+		except Exception:
+			self.logger.exception("Failed to match pip updates to subscriptions, calling all update callbacks")
+			matched = None
 		for feature in self.features:
-			feature.on_pip_update(updates)
+			callbacks = [
+				callback for callback in feature._update_callbacks
+				if matched is None or (feature, callback) in matched
+			]
+			self.update_callbacks_called += len(callbacks)
+			self.update_callbacks_skipped += len(feature._update_callbacks) - len(callbacks)
+			if callbacks:
+				feature.on_pip_update(updates, callbacks)
+
+	def quiesce(self, timeout):
+		"""Stop processing pip data and chat without closing the pip connection,
+		so the stream can be resumed in another process.
+		We must stop between pip messages, either while the pip client is waiting for a new message
+		(so an idle stream stops immediately) or in our update callback. Waits up to timeout for one of these,
+		raising gevent.Timeout if neither happens (in which case the bot continues as normal).
+		If we fail before we've stopped reading, the bot also continues as normal. If we fail after, the bot is stopped.
+		Returns (pip_sock, state) to be passed to PippyBot() to resume. The bot is unusable afterwards.
+		"""
+		self._quiesce_waiter = gevent.event.AsyncResult()
+		deadline = time.time() + timeout
+		while not (self._quiesce_waiter.ready() or self._pip_socket.idle):
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				self._quiesce_waiter = None
+				raise gevent.Timeout(timeout)
+			gevent.wait([self._quiesce_waiter, self._pip_socket.became_idle], count=1, timeout=remaining)
+		# we're between pip messages and don't yield until we've detached, so the state matches the connection
+		try:
+			state = self.get_state()
+			pip_sock = socket.fromfd(self._pip_sock.fileno(), AF_INET, SOCK_STREAM)
+		except Exception:
+			self._quiesce_waiter = None
+			self._release_reader()
+			raise
+		self.quiesced = True
+		try:
+			# stop the client reading, keeping any data it was waiting on to pass on with the connection
+			self._pip_socket.detach()
+			state['unread'] = base64.b64encode(self._pip_socket.unread)
+			if self._dispatcher:
+				self._dispatcher.kill(block=True)
+			for feature in self.features:
+				feature.stop()
+			self._flush_say()
+			self.pippy.close()
+		except Exception:
+			# we can no longer continue or hand off the stream, so close it
+			pip_sock.close()
+			self.stop()
+			raise
+		finally:
+			self._release_reader()
+		return pip_sock, state
+
+	def _release_reader(self):
+		"""Let the pip client's reader continue if it's waiting in on_pip_update() for us to quiesce"""
+		released, self._reader_released = self._reader_released, gevent.event.Event()
+		released.set()
+
+	def get_state(self):
+		"""Returns a json-serializable dict of the bot's state"""
+		return dict(
+			last_use_version = self.use_item_lock._last_use_version,
+			features = {feature.name: feature.get_state() for feature in self.features},
+			pipdata = base64.b64encode(pickle.dumps(self.pippy.pipdata, pickle.HIGHEST_PROTOCOL)),
+			unread = base64.b64encode(self._pip_socket.unread),
+		)
 
-	def say(self, text):
-		self.ipc.send_chat(self.stream_name, text)
+	def say(self, text, priority='reply'):
+		"""Send text to chat. priority is one of pipirc.ratelimit.PRIORITIES, and determines which messages
+		are sent first when we're being rate limited.
+		Unless disabled by config, text said within COALESCE_WINDOW of sending a message is held until the end
+		of the window and sent together with any other lines of the same priority said in that time.
+		Otherwise it's sent immediately."""
+		if not self.config.coalesce_chat:
+			self.ipc.send_chat(self.stream_name, text, priority)
+			return
+		if self._say_buffer and priority != self._say_priority:
+			self._flush_say()
+		if not self._say_flusher:
+			self.ipc.send_chat(self.stream_name, text, priority)
+			self._say_flusher = gevent.spawn_later(self.COALESCE_WINDOW, self._flush_say)
+			return
+		self._say_buffer.append(text)
+		self._say_priority = priority
+
+	def _flush_say(self):
+		flusher, self._say_flusher = self._say_flusher, None
+		if flusher and flusher is not gevent.getcurrent():
+			flusher.kill(block=False)
+		lines, self._say_buffer = self._say_buffer, []
+		for message in coalesce_lines(lines, self.COALESCE_SEPARATOR, self.MAX_MESSAGE_BYTES):
+			self.ipc.send_chat(self.stream_name, message, self._say_priority)
 
 	def debug(self, text):
 		"""Say if debug is True"""
 		if self.config.debug:
-			self.say(text)
+			self.say(text, priority='debug')
 
 	def stop(self):
 		"""Stop the bot and disconnect from the pip boy"""
@@ -86,12 +364,18 @@ class PippyBot(HasLogger):
 			self.pippy.close()
 		else:
 			self._pippy.kill(block=False)
+		if self._dispatcher:
+			self._dispatcher.kill(block=False)
 		for feature in self.features:
 			feature.stop()
 		try:
 			self.debug("Disconnected")
 		except Exception:
 			pass
+		try:
+			self._flush_say()
+		except Exception:
+			pass
 		self.ipc.close_stream(self.stream_name)
 
 	@property
@@ -108,18 +392,48 @@ class PippyBot(HasLogger):
 			self.stop()
 			raise
 
+	def mark_checkpointed(self):
+		"""Note that the master holds our current state. Before we next read from the pip connection,
+		we tell the master to drop it and wait for it to do so, as it could no longer be resumed from."""
+		self.checkpointed = True
+		self._pip_socket.before_read = self._checkpoint_stale
+
+	def _checkpoint_stale(self):
+		self.checkpointed = False
+		self.ipc.checkpoint_stale(self.stream_name)
+
+	@property
+	def between_messages(self):
+		"""Whether the pip client is waiting for a new pip message, so our state reflects everything read so far"""
+		return self._pip_socket.idle
+
+	@property
+	def ready(self):
+		"""Whether initial pip data has been recieved"""
+		return self._data_ready.is_set()
+
 	@property
 	def pipdata(self):
 		self._data_ready.wait()
 		return self.pippy.pipdata
 
+	@property
+	def view_cache_hits(self):
+		return self._views.hits
+
+	@property
+	def view_cache_misses(self):
+		return self._views.misses
+
 	@property
 	def player(self):
-		return Player(self.pipdata)
+		"""A Player view of the pip data. The same one is returned until the next pip update."""
+		return self._views.get(Player, self.pipdata, self.pip_updates)
 
 	@property
 	def inventory(self):
-		return Inventory(self.pipdata)
+		"""An Inventory view of the pip data. The same one is returned until the next pip update."""
+		return self._views.get(Inventory, self.pipdata, self.pip_updates)
 
 	def use_item(self, item):
 		"""Attempt to use an item. May fail if the item has disappeared since you acquired your reference to it.
@@ -130,11 +444,7 @@ class PippyBot(HasLogger):
 			version = self.inventory.version
 			self.use_item_lock.set_last_use_version(version)
 			# confirm item is still present
-			found_items = [i for i in self.inventory.items if i.handle_id == item.handle_id]
-			if len(found_items) > 1:
-				self.logger.warning("Got duplicate handle id for multiple items: {}".format(found_items))
-				found_items = found_items[:1] # take first one
-			if not found_items:
+			if self.inventory_index.get(item.handle_id) is None:
 				raise UserError("Failed to use {}: item no longer exists".format(item.name))
 			self.pippy.use_item(item.handle_id, version, block=False)
 
@@ -0,0 +1,41 @@
+
+"""Matching chat messages against what a stream's features could possibly respond to.
+
+Workers describe, per stream, which commands and message patterns their features handle
+(see PippyBot.get_chat_filter()), so the master can drop the majority of chat that
+would be ignored without sending it to the worker at all.
+"""
+
+import re
+
+
+class ChatFilter(object):
+	"""Matches a chat message if its first word is one of commands, it matches (by re.search)
+	any of patterns, or match_all is set."""
+
+	def __init__(self, commands=(), patterns=(), match_all=False):
+		self.commands = frozenset(commands)
+		self.patterns = list(patterns)
+		self.match_all = match_all
+		# patterns are kept seperate rather than joined into one regex, as joining renumbers groups,
+		# which would break any backreferences
+		self._regexes = []
+		for pattern in self.patterns:
+			try:
+				self._regexes.append(re.compile(pattern))
+			except re.error:
+				# the worker passes all chat to a callback with a bad pattern, so we must too
+				self.match_all = True
+
+	def describe(self):
+		"""Returns json-serializable kwargs to recreate this filter"""
+		return dict(commands=list(self.commands), patterns=self.patterns, match_all=self.match_all)
+
+	def matches(self, text):
+		if self.match_all:
+			return True
+		words = text.split(None, 1)
+		if words and words[0] in self.commands:
+			return True
+		return any(regex.search(text) is not None for regex in self._regexes)
+
@@ -0,0 +1,118 @@
+
+import json
+import struct
+
+
+class JSONCodec(object):
+	"""The original newline-seperated-json protocol.
+	Always used for the init handshake, and as a fallback if the other end doesn't support anything better."""
+	name = 'json'
+
+	def encode(self, msg):
+		return json.dumps(msg) + '\n'
+
+	def decode(self, buf, pos):
+		"""Attempt to decode one message from buf starting at pos.
+		Returns (msg, new pos), or (None, pos) if buf does not yet contain a whole message.
+		If the message was sent with an fd, msg will contain an 'fd' key, and the caller is responsible
+		for receiving the actual fd."""
+		end = buf.find('\n', pos)
+		if end < 0:
+			return None, pos
+		return json.loads(buf[pos:end]), end + 1
+
+
+class BinaryCodec(object):
+	"""A length-prefixed binary framing. Each frame is a header of (payload length, type id, flags)
+	followed by the payload.
+	For the common message types listed in MESSAGE_TYPES, the payload is the message's fields in order,
+	utf-8 encoded and NUL-seperated, which is much cheaper to encode and decode than json.
+	Trailing fields may be absent (or None), and are omitted.
+	Any other message (or one whose values don't fit that form) is sent as type GENERIC with a json payload.
+	A 'batch' message is sent as type BATCH, with its messages encoded as frames one after the other as its payload.
+	"""
+	name = 'binary'
+
+	HEADER = struct.Struct('!IBB') # payload length, type id, flags
+	SEPARATOR = '\0'
+
+	FLAG_FD = 1 # an fd is sent immediately after this frame
+
+	GENERIC = 0
+	BATCH = 0xff
+	# (type, fields) for all types with a compact encoding. Type ids are assigned by position, starting at 1,
+	# so only append to this list.
+	MESSAGE_TYPES = [
+		('codec', ('name',)),
+		('open stream', ('stream',)),
+		('close stream', ('stream',)),
+		('chat message', ('stream', 'text', 'sender', 'sender_rank')),
+	]
+
+	def __init__(self):
+		self._types_by_id = {type_id: message_type for type_id, message_type in enumerate(self.MESSAGE_TYPES, 1)}
+		self._types_by_name = {
+			name: (type_id, fields, frozenset(fields) | {'type', 'fd'})
+			for type_id, (name, fields) in self._types_by_id.items()
+		}
+
+	def encode(self, msg):
+		flags = self.FLAG_FD if msg.get('fd') is not None else 0
+		type_id, payload = self.GENERIC, None
+		if msg['type'] == 'batch':
+			type_id = self.BATCH
+			payload = ''.join(self.encode(submsg) for submsg in msg['messages'])
+		elif msg['type'] in self._types_by_name:
+			type_id, fields, allowed_keys = self._types_by_name[msg['type']]
+			if allowed_keys.issuperset(msg):
+				payload = self._pack_fields(msg, fields)
+		if payload is None:
+			type_id = self.GENERIC
+			payload = json.dumps({key: value for key, value in msg.items() if key != 'fd'})
+		return self.HEADER.pack(len(payload), type_id, flags) + payload
+
+	def _pack_fields(self, msg, fields):
+		"""Returns packed payload, or None if msg can't be represented in compact form"""
+		values = [msg.get(field) for field in fields]
+		while values and values[-1] is None:
+			values.pop()
+		try:
+			payload = self.SEPARATOR.join(values)
+		except (TypeError, UnicodeDecodeError):
+			return None # non-string values (including non-trailing None), or a mix we can't safely encode
+		if isinstance(payload, unicode):
+			payload = payload.encode('utf-8')
+		if payload.count(self.SEPARATOR) != max(len(values) - 1, 0):
+			return None # a value contained the seperator
+		if values and not payload:
+			return None # a single empty field would be indistinguishable from no fields
+		return payload
+
+	def decode(self, buf, pos):
+		"""As JSONCodec.decode()"""
+		if len(buf) - pos < self.HEADER.size:
+			return None, pos
+		length, type_id, flags = self.HEADER.unpack_from(buf, pos)
+		start = pos + self.HEADER.size
+		end = start + length
+		if len(buf) < end:
+			return None, pos
+		if type_id == self.GENERIC:
+			msg = json.loads(buf[start:end])
+		elif type_id == self.BATCH:
+			msg = {'type': 'batch', 'messages': []}
+			while start < end:
+				submsg, start = self.decode(buf, start)
+				msg['messages'].append(submsg)
+		else:
+			name, fields = self._types_by_id[type_id]
+			parts = buf[start:end].split(self.SEPARATOR) if length else []
+			msg = {field: part.decode('utf-8') for field, part in zip(fields, parts)}
+			msg['type'] = name
+		if flags & self.FLAG_FD:
+			msg['fd'] = None
+		return msg, end
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), BinaryCodec())}
+
@@ -12,6 +12,28 @@ class ServiceConfig(object):
 			'The socket address to bind to for accepting incoming Pip Boy connections.\n'
 			'Should be a string of form "{ipv4}:{port}", "[{ipv6}:{port}]" or integer port '
 			'as a shortcut for "0.0.0.0:{port}".',
+		'pip_handshake_timeout':
+			'Time in seconds a new pip boy connection has to send its pip key before being disconnected.',
+		'pip_max_handshakes':
+			'The most new pip boy connections to authenticate at once. Further connections wait to be accepted.',
+		'pip_listen_backlog':
+			'The most pip boy connections to hold waiting to be accepted, beyond which connections are refused.',
+		'pip_connects_per_ip':
+			'Limits how often one IP address may connect, as [connections, seconds]. '
+			'An IP may connect that many times at once, then regains one connection every seconds/connections. '
+			'Set to null for no limit.',
+		'pip_dispatch_window':
+			'Time in seconds to collect pip updates for a stream before passing them to its features together, '
+			'so a burst of small updates (eg. opening a container) is handled once rather than for each one. '
+			'Updates that arrive while a stream is waiting to pass on earlier ones are always merged with them.',
+		'pip_dispatch_max_rate':
+			'The most times per second to pass pip updates to a stream\'s features, with updates arriving faster '
+			'than this being merged. Set to null for no limit.',
+		'pip_reuseport':
+			'If true, each worker binds the listen address itself (with SO_REUSEPORT) and accepts and '
+			'authenticates pip boy connections directly, instead of the master accepting them all and passing '
+			'them to workers. Requires a kernel supporting SO_REUSEPORT (Linux 3.9+). Limits above then apply '
+			'per worker, and the kernel rather than placement_policy decides which worker gets a new stream.',
 		'logging':
 			'Options for configuring logging. Should be an object with keys and values as per '
 			'logging.basicConfig(), eg. {"level": "INFO", "filename": "foo.log"}',
@@ -22,6 +44,99 @@ class ServiceConfig(object):
 			'Main twitch user to use when not using a custom one.',
 		'default_irc_oauth':
 			'OAuth token to authenticate as default_irc_user for twitch IRC.',
+		'irc_gateways':
+			'When set, irc connections are run in this many separate gateway processes instead of in the master, '
+			'so chat traffic doesn\'t compete with the master\'s other work. All streams using the same twitch user '
+			'are handled by the same gateway, so rate limits are still enforced per user.',
+		'irc_connections_per_user':
+			'Channels of all streams using the same twitch user (eg. the default user) are spread across '
+			'up to this many irc connections for that user. Channels are assigned to connections by '
+			'consistent hashing, so changing this only moves some channels.',
+		'ipc_codecs':
+			'List of codecs to use for master/worker communication, in order of preference. '
+			'Options are "binary" and "json". json is always available as a fallback. '
+			'binary messages are about half the size, but with batching (see ipc_batch_size) json is '
+			'much cheaper on CPU, so only prefer binary if bandwidth between processes is the bottleneck.',
+		'ipc_batch_size':
+			'Chat messages between master and workers are batched together. This is the most messages '
+			'to hold before sending the batch. Set to 0 to disable batching.',
+		'ipc_batch_delay':
+			'The longest time in seconds to hold a chat message while waiting for more to batch with it. '
+			'Set to 0 to disable batching.',
+		'placement_policy':
+			'How to choose which worker a new stream is placed on. One of "least_streams", "least_cpu", '
+			'"weighted" (a weighted sum of cpu, pip update rate, greenlets, memory and streams) '
+			'or "power_of_two" (the better of two random workers by weighted score).',
+		'load_report_interval':
+			'How often in seconds workers report their load to the master for use in stream placement.',
+		'rebalance_threshold':
+			'When set, streams are moved between running workers whenever the difference in cpu usage '
+			'(as a fraction of one core) between the busiest and least busy workers exceeds this value. '
+			'Default is not to rebalance.',
+		'rebalance_interval':
+			'How often in seconds to check whether to rebalance streams. See rebalance_threshold.',
+		'worker_zygote':
+			'When true, workers are forked from a zygote process which has already loaded all code and config, '
+			'making (re)starting a worker much faster. When false, each worker is a new python process.',
+		'worker_spares':
+			'Number of extra workers the zygote keeps forked and waiting, so a new worker can start without '
+			'even waiting on a fork. Has no effect unless worker_zygote is set.',
+		'min_workers':
+			'The fewest worker processes to run.',
+		'max_workers':
+			'The most worker processes to run. Defaults to the number of cpus.',
+		'scale_up_cpu':
+			'Start another worker when the average cpu usage of workers (as a fraction of one core) exceeds this.',
+		'scale_up_streams':
+			'Start another worker when the average number of streams per worker exceeds this.',
+		'scale_down_cpu':
+			'Stop a worker when the average cpu usage of the remaining workers would still be below this.',
+		'scale_down_streams':
+			'Stop a worker when the average number of streams on the remaining workers would still be below this.',
+		'scale_cooldown':
+			'The minimum time in seconds between starting or stopping workers.',
+		'checkpoint_interval':
+			'Workers send the master a checkpoint of a stream\'s state once it has had no pip data updates for '
+			'this many seconds (eg. the game is paused). If a worker dies, its streams with a checkpoint that is '
+			'still current are resumed on another worker without the streamer needing to reconnect. Other streams '
+			'on a dead worker are disconnected. Checkpoints are held in the master\'s memory, and a checkpointed '
+			'stream waits for the master to drop its checkpoint before reading more pip data. '
+			'Set to 0 (the default) to disable.',
+		'handoff_socket':
+			'Path of a unix socket on which to offer our listeners, workers and streams to a new master '
+			'process, started with the "takeover" argument. This allows the master to be upgraded or '
+			'restarted without disconnecting streams. Sending the master SIGUSR2 starts the new master. '
+			'Default is to not allow handoff.',
+	}
+
+	DEFAULTS = {
+		'pip_handshake_timeout': 10,
+		'pip_max_handshakes': 100,
+		'pip_listen_backlog': 256,
+		'pip_connects_per_ip': [10, 60],
+		'pip_reuseport': False,
+		'pip_dispatch_window': 0.05,
+		'pip_dispatch_max_rate': 10,
+		'irc_gateways': 0,
+		'irc_connections_per_user': 1,
+		'ipc_codecs': ['json'],
+		'ipc_batch_size': 64,
+		'ipc_batch_delay': 0.003,
+		'placement_policy': 'weighted',
+		'load_report_interval': 5,
+		'rebalance_threshold': None,
+		'rebalance_interval': 60,
+		'worker_zygote': True,
+		'worker_spares': 0,
+		'min_workers': 1,
+		'max_workers': None,
+		'scale_up_cpu': 0.7,
+		'scale_up_streams': 50,
+		'scale_down_cpu': 0.3,
+		'scale_down_streams': 20,
+		'scale_cooldown': 60,
+		'checkpoint_interval': 0,
+		'handoff_socket': None,
 	}
 
 	def __init__(self, filepath):
@@ -30,7 +145,8 @@ class ServiceConfig(object):
 			data = json.loads(f.read())
 
 		for key in self.ITEMS:
-			setattr(self, key, data.pop(key))
+			value = data.pop(key, self.DEFAULTS[key]) if key in self.DEFAULTS else data.pop(key)
+			setattr(self, key, value)
 
 		self.streams = {name: Stream(name, stream, self) for name, stream in self.streams.items()}
 
@@ -10,19 +10,38 @@ from classtricks import HasLogger, NoOpContext, classproperty, get_all_subclasse
 import deepclient
 
 
-def on_message(fn):
+def on_message(fn=None, pattern=None):
 	"""Decorate class methods with this to have them called upon any chat message being recieved.
-	Wrapped functions should take args (text, sender, sender_rank)"""
-	fn._on_message = True
-	return fn
+	Wrapped functions should take args (text, sender, sender_rank)
+	Use as @on_message(pattern=regex) to declare that the method ignores any message that doesn't
+	match regex (by re.search), which lets most chat be filtered out before it reaches the worker.
+	pattern may also be a function taking the feature and returning the regex, for configurable patterns.
+	Without a pattern, the feature must be sent all chat.
+	"""
+	def _on_message(fn):
+		fn._on_message = True
+		fn._message_pattern = pattern
+		return fn
+	if fn is None:
+		return _on_message
+	return _on_message(fn)
 
 
-def on_update(fn):
+def on_update(fn=None, paths=None):
 	"""Decorate class methods with this to have them called upon any pip data update.
 	Wrapped functions should take a list of updated values, though in most cases it's probably better
-	to ignore them and just consult pippy directly."""
-	fn._on_update = True
-	return fn
+	to ignore them and just consult pippy directly.
+	Use as @on_update(paths=[...]) to only be called for updates that touch one of paths, eg. 'Inventory'
+	or 'Map.CurrCell', or for which a path given as a function returns True for any updated value.
+	See pipirc.subscriptions.
+	"""
+	def _on_update(fn):
+		fn._on_update = True
+		fn._update_paths = paths
+		return fn
+	if fn is None:
+		return _on_update
+	return _on_update(fn)
 
 
 class UserError(Exception):
@@ -92,12 +111,33 @@ class Feature(HasLogger):
 		}
 		return OrderedDict(sorted(result.items()))
 
-	def recv_chat(self, text, sender, sender_rank):
+	def get_chat_routes(self):
+		"""Returns (commands, handlers) describing our message callbacks, where commands is a list of
+		(command with prefix, BoundCommand) and handlers is a list of (callback, regex pattern),
+		with a pattern of None for callbacks that must be sent all chat."""
+		commands = []
+		handlers = []
 		for callback in self._message_callbacks:
-			self.group.spawn(self._log_errors, callback, text, sender, sender_rank)
-
-	def on_pip_update(self, updates):
-		for callback in self._update_callbacks:
+			if isinstance(callback, BoundCommand):
+				commands.append((callback.full_prefix(self), callback))
+				continue
+			pattern = getattr(callback, '_message_pattern', None)
+			if callable(pattern):
+				pattern = pattern(self)
+			handlers.append((callback, pattern))
+		return commands, handlers
+
+	def get_chat_filter(self):
+		"""Returns (commands, patterns, match_all) describing which chat messages this feature might act on.
+		See pipirc.chatfilter:ChatFilter."""
+		commands, handlers = self.get_chat_routes()
+		patterns = [pattern for callback, pattern in handlers if pattern is not None]
+		match_all = any(pattern is None for callback, pattern in handlers)
+		return {prefix for prefix, command in commands}, patterns, match_all
+
+	def on_pip_update(self, updates, callbacks=None):
+		"""Call our update callbacks, or only those in callbacks"""
+		for callback in self._update_callbacks if callbacks is None else callbacks:
 			self.group.spawn(self._log_errors, callback, updates)
 
 	def _log_errors(self, fn, *args, **kwargs):
@@ -113,6 +153,13 @@ class Feature(HasLogger):
 	def init(self):
 		"""Optional feature init hook"""
 
+	def get_state(self):
+		"""Optional hook to return json-serializable state, which will be passed to set_state()
+		if the stream is moved to another worker."""
+
+	def set_state(self, state):
+		"""Optional hook to restore state from get_state(). Called after init()."""
+
 	def _stop(self):
 		"""Optional feature shutdown hook"""
 
@@ -204,10 +251,12 @@ class Command(object):
 		prefix = self.full_prefix(feature)
 		args = text.strip().split()
 		feature.logger.debug("Considering message {} for command {}".format(args, self))
-		if args[0] != prefix:
+		if not args or args[0] != prefix:
 			return
-		args = args[1:]
+		self.run(feature, args[1:], text, sender, sender_rank)
 
+	def run(self, feature, args, text, sender, sender_rank):
+		"""Run the command for a message already known to be for it, with args being the words after the command"""
 		config = self.get_config(feature.config)
 		is_mod = sender_rank in ('broadcaster', 'mod')
 		now = time.time()
@@ -243,7 +292,7 @@ class Command(object):
 		except UserError as ex:
 			fail = config['fail_message']
 			if fail is True or self.last_failed is None or now - self.last_failed >= fail or is_mod:
-				feature.bot.say(str(ex))
+				feature.bot.say(str(ex), priority='error')
 			self.last_failed = now
 
 
@@ -261,6 +310,9 @@ class BoundCommand(object):
 	def __call__(self, *args, **kwargs):
 		return self._command(self._feature, *args, **kwargs)
 
+	def run(self, *args, **kwargs):
+		return self._command.run(self._feature, *args, **kwargs)
+
 	@property
 	def config(self):
 		return self._command.get_config(self._feature)
@@ -21,7 +21,7 @@ class DeepbotPollResponse(Feature):
 		'pattern': r'^Poll for .* has been closed. Winning option was Slot (\d+)$',
 	}
 
-	@on_message
+	@on_message(pattern=lambda self: self.pattern)
 	def respond_to_poll(self, text, sender, sender_rank):
 		if sender_rank not in ('mod', 'broadcaster'):
 			return
@@ -34,4 +34,4 @@ class DeepbotPollResponse(Feature):
 		try:
 			use_favorite_slot(self.bot, slot - 1)
 		except UserError as ex:
-			self.bot.say("Failed to apply poll result: {}".format(ex))
+			self.bot.say("Failed to apply poll result: {}".format(ex), priority='error')
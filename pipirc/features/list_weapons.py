@@ -8,7 +8,7 @@ class ListWeapons(Feature):
 	@command('weapons')
 	def weapons(self, sender, sender_rank, *args):
 		"""List all favorited weapon slots"""
-		favorites = [item for item in self.bot.inventory.weapons if item.favorite]
+		favorites = [item for item in self.bot.inventory_index.weapons() if item.favorite]
 		favorites = {item.name: item for item in favorites}.values()
 		favorites.sort(key=lambda item: item.favorite_slot)
 		self.bot.say("Favorited items:")
@@ -8,7 +8,7 @@ class Test(Feature):
 	def init(self):
 		self.bot.say("Hello!")
 
-	@on_message
+	@on_message(pattern='pippy')
 	def echo(self, text, sender, sender_rank):
 		if 'pippy' in text:
 			self.bot.say("hello {} {}".format(sender_rank, sender))
@@ -11,7 +11,7 @@ class UseBooze(Feature):
 	def booze(self, sender, sender_rank, *args):
 		"""Use a random booze item"""
 		with self.bot.use_item_lock:
-			booze = [item for item in self.bot.inventory.aid if item.name.lower() in item.ALCOHOL_NAMES]
+			booze = self.bot.inventory_index.booze()
 			if not booze:
 				raise UserError("Sorry, {} is trying to cut back (Not carrying any booze)".format(self.bot.player.name))
 			item = random.choice(booze)
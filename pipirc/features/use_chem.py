@@ -16,12 +16,12 @@ class UseChem(Feature):
 		if name.lower() not in Item.CHEM_NAMES:
 			raise UserError("{} is not a chem we can use".format(name))
 		with self.bot.use_item_lock:
-			matching = [item for item in self.bot.inventory.aid if item.name.lower() == name.lower()]
+			matching = [item for item in self.bot.inventory_index.by_name(name) if self.bot.inventory_index.is_chem(item)]
 			if not matching:
-				raise UserError("{} is not carrying any {}".format(self.player.name, name))
+				raise UserError("{} is not carrying any {}".format(self.bot.player.name, name))
 			if len(matching) > 1:
 				self.logger.warning("Carrying multiple copies of chem named {!r}: {}".format(name, matching))
-				matching = matching[0]
+				matching = matching[:1]
 			item, = matching
 			self.bot.use_item(item)
 		fmt = random.choice([
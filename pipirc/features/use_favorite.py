@@ -17,7 +17,7 @@ class UseFavorite(Feature):
 
 def use_favorite_slot(bot, index):
 	with bot.use_item_lock:
-		items = [item for item in bot.inventory.items if item.favorite_slot == index]
+		items = bot.inventory_index.by_favorite_slot(index)
 		if not items:
 			raise UserError("No item attached to that favorite slot")
 		if len(items) > 1:
@@ -30,7 +30,7 @@ def use_favorite_slot(bot, index):
 		if item.equipped:
 			raise UserError("Sorry, you can't equip something that's already equipped")
 		bot.use_item(item)
-		verb = 'Equipped' if item in bot.inventory.weapons else 'Used'
+		verb = 'Equipped' if bot.inventory_index.is_weapon(item) else 'Used'
 		text = "{verb} {item.name}".format(item=item)
 		is_outdoors = not bot.player.value['Map']['CurrCell']
 		if item.ammo_type and not item.ammo:
@@ -18,6 +18,12 @@ class WebPippyUpload(Feature):
 		"interval": 15,
 	}
 
+	def get_state(self):
+		return self.last_upload
+
+	def set_state(self, state):
+		self.last_upload = state
+
 	@on_update
 	def upload(self, updates):
 		now = time.time()
@@ -0,0 +1,303 @@
+
+from socket import AF_UNIX, SOCK_STREAM
+from uuid import uuid4
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from gevent.pool import Group
+import gevent
+
+from classtricks import HasLogger
+
+from .chatfilter import ChatFilter
+from .config import ServiceConfig
+from .ipc import IPCConnection
+from .irc import HashRing, IRCHostsManager
+
+
+class IRCGateways(HasLogger):
+	"""Master-side stand-in for IRCHostsManager, which runs the actual irc clients in separate gateway processes
+	so that irc traffic doesn't compete with the rest of the master for its event loop.
+
+	Each twitch user is owned by exactly one gateway (by consistent hashing of the nick), so all the rate limit
+	state for an account lives in a single process and needs no coordination.
+	Gateways talk to us over a unix socket using the same message protocol as workers (see pipirc.ipc).
+	We remember all streams and chat filters, so a gateway that dies can be restarted and re-sent its streams.
+	"""
+
+	GATEWAY_RESPAWN_INTERVAL = 1
+	GATEWAY_MIN_UPTIME = 10
+	GATEWAY_STOP_TIMEOUT = 60 # how long to wait for gateways to flush their messages before killing them
+
+	stopping = False
+
+	def __init__(self, main, count, logger=None):
+		super(IRCGateways, self).__init__(logger=logger)
+		self.main = main
+		self.count = count
+		self.sock_path = '/tmp/{}.sock'.format(uuid4())
+		self.listener = socket.socket(AF_UNIX, SOCK_STREAM)
+		self.listener.bind(self.sock_path)
+		self.listener.listen(count)
+		self.conns = {} # {index: GatewayMasterConnection}, only for gateways that have finished init
+		self.streams = {} # {stream name: (host, nick, oauth, channel)}
+		self.chat_filters = {} # {stream name: ChatFilter}
+		self._ring = HashRing(count)
+		self.group = Group()
+		self._accept_loop = self.group.spawn(self._accept)
+		self._watchdogs = Group()
+		for index in range(count):
+			self._watchdogs.spawn(self._gateway_watchdog, index)
+
+	def _accept(self):
+		while True:
+			sock, _ = self.listener.accept()
+			GatewayMasterConnection(self, sock, logger=self.logger).start()
+
+	def _gateway_watchdog(self, index):
+		while not self.stopping:
+			self.logger.info("Starting irc gateway {}".format(index))
+			started = time.time()
+			proc = None
+			try:
+				proc = subprocess.Popen([
+					sys.executable,
+					'-m', 'pipirc', 'gateway',
+					self.main.config.filepath, self.sock_path, str(index),
+				])
+				returncode = proc.wait()
+			except Exception:
+				self.logger.exception("Error starting or waiting on irc gateway {}".format(index))
+			else:
+				if returncode == 0:
+					self.logger.info("Irc gateway {} cleanly shut down".format(index))
+					return
+				self.logger.error("Irc gateway {} died with exit code {}".format(index, returncode))
+			finally:
+				if proc and proc.returncode is None:
+					try:
+						proc.kill()
+					except OSError:
+						pass
+			if time.time() - started < self.GATEWAY_MIN_UPTIME:
+				gevent.sleep(self.GATEWAY_RESPAWN_INTERVAL * random.uniform(0.9, 1.1))
+
+	def _gateway_for(self, name):
+		host, nick, oauth, channel = self.streams[name]
+		return self._ring.get(nick.lower())
+
+	def _conn_for(self, name):
+		"""Returns the conn for the gateway that owns stream name, or None if it isn't running"""
+		return self.conns.get(self._gateway_for(name))
+
+	def _registered(self, conn):
+		"""Called once a gateway has finished init. Sends it all the streams it owns."""
+		self.conns[conn.index] = conn
+		streams = [name for name in self.streams if self._gateway_for(name) == conn.index]
+		conn.send('sync streams', connections=[(name,) + self.streams[name] for name in streams])
+		for name in streams:
+			if name in self.chat_filters:
+				conn.send('chat filter', stream=name, **self.chat_filters[name].describe())
+
+	def _unregistered(self, conn):
+		if self.conns.get(conn.index) is conn:
+			del self.conns[conn.index]
+
+	def send(self, name, msg, priority='reply'):
+		if name not in self.streams:
+			self.logger.warning("Tried to send message for unknown stream {!r}: {!r}".format(name, msg))
+			return
+		conn = self._conn_for(name)
+		if not conn:
+			self.logger.warning("Dropping message for stream {!r} as its irc gateway is down: {!r}".format(name, msg))
+			return
+		if priority == 'reply':
+			conn.send('chat message', stream=name, text=msg)
+		else:
+			conn.send('chat message', stream=name, text=msg, priority=priority)
+
+	def add_stream(self, name, host, nick, oauth, channel):
+		if self.streams.get(name) == (host, nick, oauth, channel):
+			return
+		if name in self.streams:
+			self.remove_stream(name) # config changed
+		self.streams[name] = host, nick, oauth, channel
+		conn = self._conn_for(name)
+		if conn:
+			conn.send('add stream', name=name, host=host, nick=nick, oauth=oauth, channel=channel)
+
+	def remove_stream(self, name):
+		if name not in self.streams:
+			return
+		conn = self._conn_for(name)
+		del self.streams[name]
+		self.chat_filters.pop(name, None)
+		if conn:
+			conn.send('remove stream', name=name)
+
+	def set_chat_filter(self, name, chat_filter):
+		"""Set the ChatFilter for stream name, or remove it if chat_filter is None"""
+		if chat_filter is None:
+			self.chat_filters.pop(name, None)
+		else:
+			self.chat_filters[name] = chat_filter
+		conn = self._conn_for(name) if name in self.streams else None
+		if conn:
+			description = chat_filter.describe() if chat_filter else dict(commands=[], patterns=[], match_all=True)
+			conn.send('chat filter', stream=name, **description)
+
+	def update_connections(self, connections):
+		"""As IRCHostsManager.update_connections()"""
+		self.streams = {name: (host, nick, oauth, channel) for name, host, nick, oauth, channel in connections}
+		for index, conn in self.conns.items():
+			conn.send('sync streams', connections=[
+				(name,) + self.streams[name] for name in self.streams
+				if self._gateway_for(name) == index
+			])
+
+	def recv_chat(self, stream, text, sender, sender_rank):
+		self.main.ipc_server.recv_chat(stream, text, sender, sender_rank)
+
+	def stop(self):
+		"""Gracefully stop all gateways, waiting for them to send any remaining messages"""
+		self.stopping = True
+		self._accept_loop.kill(block=False)
+		for conn in self.conns.values():
+			conn.send('stop')
+		self._watchdogs.join(timeout=self.GATEWAY_STOP_TIMEOUT)
+		self._watchdogs.kill(block=True) # kills any gateway that didn't stop in time
+		self.group.kill(block=True)
+		os.unlink(self.sock_path)
+
+
+class GatewayMasterConnection(IPCConnection):
+	"""Master's end of the connection to an irc gateway"""
+
+	index = None
+
+	def __init__(self, gateways, socket, logger=None):
+		config = gateways.main.config
+		super(GatewayMasterConnection, self).__init__(
+			socket, batch_size=config.ipc_batch_size, batch_delay=config.ipc_batch_delay, logger=logger,
+		)
+		self.gateways = gateways
+		self._handle_map = {
+			'batch': self._batch,
+			'chat message': self.gateways.recv_chat,
+			'codec': self._codec,
+			'init': self._init,
+		}
+
+	def _init(self, name, index, codecs=('json',)):
+		self.name = name
+		self.index = index
+		self._choose_codec(self.gateways.main.config.ipc_codecs, codecs)
+		self.gateways._registered(self)
+
+	def _stop(self, ex=None):
+		super(GatewayMasterConnection, self)._stop()
+		self.gateways._unregistered(self)
+
+
+class GatewayConnection(IPCConnection):
+	"""Gateway's end of the connection to the master. Runs an IRCHostsManager on the master's behalf."""
+
+	def __init__(self, index, sock_path, config, logger=None):
+		self.index = index
+		self.name = 'gateway-{}'.format(index)
+		self.config = config
+		self.chat_filters = {} # {stream: ChatFilter}
+		self.chat_filtered = 0 # count of chat messages dropped as no feature would act on them
+		self._handle_map = {
+			'add stream': self._add_stream,
+			'batch': self._batch,
+			'chat filter': self._chat_filter,
+			'chat message': self._send_chat,
+			'codec': self._codec,
+			'remove stream': self._remove_stream,
+			'stop': self._stop_gracefully,
+			'sync streams': self._sync_streams,
+		}
+
+		sock = socket.socket(AF_UNIX, SOCK_STREAM)
+		sock.connect(sock_path)
+		super(GatewayConnection, self).__init__(
+			sock, batch_size=config.ipc_batch_size, batch_delay=config.ipc_batch_delay, logger=logger,
+		)
+		self.irc_manager = IRCHostsManager(
+			self.recv_chat, config.irc_connections_per_user, chat_filter=self._wants_chat, logger=self.logger,
+		)
+
+		self.send('init', name=self.name, index=self.index, codecs=config.ipc_codecs)
+
+	def _codec(self, name):
+		super(GatewayConnection, self)._codec(name)
+		# confirm, so master knows everything we send from here on uses the new codec
+		self.send('codec', name=name)
+
+	def _wants_chat(self, stream, text):
+		chat_filter = self.chat_filters.get(stream)
+		if chat_filter and not chat_filter.matches(text):
+			self.chat_filtered += 1
+			return False
+		return True
+
+	def recv_chat(self, stream, text, sender, sender_rank):
+		self.send('chat message', stream=stream, text=text, sender=sender, sender_rank=sender_rank)
+
+	def _send_chat(self, stream, text, priority='reply'):
+		self.irc_manager.send(stream, text, priority)
+
+	def _add_stream(self, name, host, nick, oauth, channel):
+		self.irc_manager.add_stream(name, host, nick, oauth, channel)
+
+	def _remove_stream(self, name):
+		self.chat_filters.pop(name, None)
+		self.irc_manager.remove_stream(name)
+
+	def _sync_streams(self, connections):
+		connections = [tuple(connection) for connection in connections]
+		self.irc_manager.update_connections(connections)
+		streams = {connection[0] for connection in connections}
+		for stream in set(self.chat_filters) - streams:
+			del self.chat_filters[stream]
+
+	def _chat_filter(self, stream, commands, patterns, match_all):
+		if match_all:
+			self.chat_filters.pop(stream, None)
+		else:
+			self.chat_filters[stream] = ChatFilter(commands, patterns)
+
+	def _stop_gracefully(self):
+		# we can't stop from within our own group
+		gevent.spawn(self._flush_and_stop)
+
+	def _flush_and_stop(self):
+		self.irc_manager.stop()
+		self.stop()
+
+
+def main(conf_path, sock_path, index):
+	"""Entry point for irc gateway processes"""
+	index = int(index)
+
+	config = ServiceConfig(conf_path)
+	config.configure_logging()
+
+	logger = logging.getLogger('pipirc.gateway').getChild(str(index))
+	logger.info("Starting")
+	conn = GatewayConnection(index, sock_path, config, logger=logger)
+	conn.start()
+	logger.info("Started")
+
+	try:
+		conn.wait_for_stop()
+	except Exception:
+		logger.exception("Fatal error in irc gateway")
+		sys.exit(1)
+	logger.info("Cleanly stopped")
@@ -0,0 +1,68 @@
+
+"""Protocol for handing off a running master's listeners, workers and streams to a new master process.
+
+The old master listens on the configured handoff_socket. A new master started in takeover mode connects to it,
+and the old master sends a single newline-terminated json object describing its state, followed by
+each fd that state refers to (by index) in order. Once the new master has received everything,
+it replies with a single ACK byte, and only then does the old master exit, without disturbing any
+workers or streams, which the new master adopts. If the ack never arrives, the old master carries on serving.
+"""
+
+from socket import AF_UNIX, SOCK_STREAM
+import json
+import os
+import socket
+
+import gevent
+
+from gtools import send_fd, recv_fd
+
+
+ACK = '\n'
+
+
+def listen(path):
+	"""Bind a handoff listener at path, replacing any existing one (eg. the previous master's)"""
+	if os.path.exists(path):
+		os.unlink(path)
+	listener = socket.socket(AF_UNIX, SOCK_STREAM)
+	listener.bind(path)
+	listener.listen(1)
+	return listener
+
+
+def send_handoff(sock, state, fds):
+	"""Send state and list of fds (which may be integers or objects with a fileno())"""
+	state = dict(state, num_fds=len(fds))
+	sock.sendall(json.dumps(state) + '\n')
+	for fd in fds:
+		send_fd(sock, fd if isinstance(fd, int) else fd.fileno())
+
+
+def wait_for_ack(sock, timeout):
+	"""Wait for the new master to confirm it has received everything from send_handoff()"""
+	with gevent.Timeout(timeout, Exception("Timed out waiting for new master to acknowledge handoff")):
+		data = sock.recv(1)
+	if data != ACK:
+		raise Exception("New master did not acknowledge handoff, got {!r}".format(data))
+
+
+def recv_handoff(path):
+	"""Connect to old master at path and return (state, fds), where fds is a list of integer fds."""
+	sock = socket.socket(AF_UNIX, SOCK_STREAM)
+	sock.connect(path)
+	try:
+		# read one byte at a time so we don't consume any of the bytes that carry the fds
+		buf = ''
+		while not buf.endswith('\n'):
+			data = sock.recv(1)
+			if not data:
+				raise Exception("Old master closed handoff connection early")
+			buf += data
+		state = json.loads(buf)
+		fds = [recv_fd(sock) for i in range(state.pop('num_fds'))]
+		sock.sendall(ACK)
+	finally:
+		sock.close()
+	return state, fds
+
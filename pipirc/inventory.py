@@ -0,0 +1,118 @@
+
+"""Indexed lookups of a bot's inventory items, so repeated lookups don't each scan the whole inventory."""
+
+
+class InventoryIndex(object):
+	"""Finds a bot's inventory items by handle id, favorite slot or name, and which are chems, booze or weapons.
+	The index is brought up to date lazily, never by pip updates themselves: the first lookup after the inventory's
+	version changes costs a pass over all items (re-indexing only items that were added, removed, renamed or moved
+	between favorite slots), much like the scan it replaces. Only further lookups at the same version are cheap.
+	Weapons are only found (by a further pass over the weapons section) when asked for.
+	Item objects returned are from the latest version of the inventory.
+	"""
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.version = None # inventory version we're up to date with
+		self._items = {} # {handle_id: Item}
+		self._keys = {} # {handle_id: (lowercase name, favorite slot)}
+		self._by_slot = {} # {favorite slot: set of handle_ids}
+		self._by_name = {} # {lowercase name: set of handle_ids}
+		self._chems = set() # handle_ids
+		self._booze = set()
+		self._weapons = None # set of handle_ids, or None if not found since the inventory last changed
+
+	def _sync(self):
+		inventory = self.bot.inventory
+		version = inventory.version
+		if version == self.version:
+			return
+		items = {}
+		for item in inventory.items:
+			if item.handle_id in items:
+				self.bot.logger.warning("Got duplicate handle id for multiple items: {}, {}".format(items[item.handle_id], item))
+				continue # take first one
+			items[item.handle_id] = item
+		for handle_id in set(self._items) - set(items):
+			self._unindex(handle_id)
+		for handle_id, item in items.items():
+			key = item.name.lower(), item.favorite_slot
+			if self._keys.get(handle_id) == key:
+				continue
+			if handle_id in self._keys:
+				self._unindex(handle_id)
+			self._index(handle_id, item, key)
+		self._items = items
+		self._weapons = None
+		self.version = version
+
+	def _index(self, handle_id, item, key):
+		name, slot = key
+		self._keys[handle_id] = key
+		self._by_name.setdefault(name, set()).add(handle_id)
+		if slot is not None:
+			self._by_slot.setdefault(slot, set()).add(handle_id)
+		# only aid items have these names, so we don't need to check the item's section
+		if name in item.CHEM_NAMES:
+			self._chems.add(handle_id)
+		if name in item.ALCOHOL_NAMES:
+			self._booze.add(handle_id)
+
+	def _unindex(self, handle_id):
+		name, slot = self._keys.pop(handle_id)
+		self._discard(self._by_name, name, handle_id)
+		self._discard(self._by_slot, slot, handle_id)
+		self._chems.discard(handle_id)
+		self._booze.discard(handle_id)
+
+	def _sync_weapons(self):
+		self._sync()
+		if self._weapons is None:
+			self._weapons = {item.handle_id for item in self.bot.inventory.weapons}
+
+	def _discard(self, index, key, handle_id):
+		handle_ids = index.get(key)
+		if handle_ids is None:
+			return
+		handle_ids.discard(handle_id)
+		if not handle_ids:
+			del index[key]
+
+	def _lookup(self, handle_ids):
+		return [self._items[handle_id] for handle_id in handle_ids]
+
+	def get(self, handle_id):
+		"""Returns the item with given handle id, or None"""
+		self._sync()
+		return self._items.get(handle_id)
+
+	def by_favorite_slot(self, slot):
+		"""Returns a list of items in the (0-indexed) favorite slot, normally at most one"""
+		self._sync()
+		return self._lookup(self._by_slot.get(slot, ()))
+
+	def by_name(self, name):
+		"""Returns a list of items with the name, ignoring case"""
+		self._sync()
+		return self._lookup(self._by_name.get(name.lower(), ()))
+
+	def chems(self):
+		self._sync()
+		return self._lookup(self._chems)
+
+	def booze(self):
+		self._sync()
+		return self._lookup(self._booze)
+
+	def weapons(self):
+		self._sync_weapons()
+		return self._lookup(handle_id for handle_id in self._weapons if handle_id in self._items)
+
+	def is_chem(self, item):
+		self._sync()
+		return item.handle_id in self._chems
+
+	def is_weapon(self, item):
+		self._sync_weapons()
+		return item.handle_id in self._weapons
+
@@ -1,13 +1,18 @@
 
 from uuid import uuid4
 from socket import AF_UNIX, AF_INET, SOCK_STREAM
-import json
+import base64
+import os
 import random
+import resource
+import signal
 import socket
 import subprocess
 import sys
+import time
 
-from gevent.event import Event
+from gevent.baseserver import parse_address
+from gevent.event import AsyncResult, Event
 from gevent.pool import Group
 import gevent
 
@@ -16,26 +21,193 @@ from gclient import GSocketClient
 from gtools import gmap, send_fd, recv_fd
 
 from .bot import PippyBot
+from .chatfilter import ChatFilter
+from .codec import CODECS
+from .pipkey import PipKeyIndex
+from .pipserver import PipConnectionServer
+from .placement import POLICIES
+from .zygote import Zygote
 
 
 class IPCServer(HasLogger):
 	WORKER_RESPAWN_INTERVAL = 1
+	WORKER_MIN_UPTIME = 10
+	DRAIN_CHECK_INTERVAL = 1
+	DRAIN_TIMEOUT = 60 # how long a draining worker's streams get to migrate before it is stopped anyway
+	DRAIN_RETRY_INTERVAL = 5 # how often to retry migrating a draining worker's streams that failed to migrate
+	WORKER_EXIT_TIMEOUT = 10 # how long a stopped worker gets to exit before it is killed
+	MIGRATE_TIMEOUT = 10
+	HANDOFF_PAUSE_TIMEOUT = 10 # how long each conn gets to finish handling its current message before a handoff
 
 	stopping = False
+	handed_off = False
 
-	def __init__(self, main, num_workers, logger=None):
+	def __init__(self, main, min_workers, max_workers, adopted=None, logger=None):
+		"""Runs between min_workers and max_workers worker processes, scaling according to load.
+		If adopted is given, it should be (state, fds) as given to a previous master's hand_off(),
+		and we take over that master's workers and streams."""
 		super(IPCServer, self).__init__(logger=logger)
-		self.sock_path = '/tmp/{}.sock'.format(uuid4())
 		self.main = main
 		self.group = Group()
-		self.listener = socket.socket(AF_UNIX, SOCK_STREAM)
-		self.listener.bind(self.sock_path)
-		self.listener.listen(128)
+		self._background = Group() # greenlets that run until stop() without needing to finish cleanly
+		self._resumes = Group() # greenlets resuming streams, which must finish before a handoff
+		if adopted:
+			state, fds = adopted
+			self.sock_path = state['sock_path']
+			self.listener = socket.fromfd(fds[state['listener']], AF_UNIX, SOCK_STREAM)
+		else:
+			self.sock_path = '/tmp/{}.sock'.format(uuid4())
+			self.listener = socket.socket(AF_UNIX, SOCK_STREAM)
+			self.listener.bind(self.sock_path)
+			self.listener.listen(128)
 		self._accept_loop = self.group.spawn(self.run)
 		self.conns = {}
+		self._drained_pids = set() # pids of workers we've drained, which aren't replaced if they die
+		self.zygote = None
+		if main.config.worker_zygote:
+			self.zygote = Zygote(main.config.filepath, self.sock_path, main.config.worker_spares, logger=self.logger)
+		self._stream_conns = {} # {stream: conn}, kept in sync with each conn's streams
+		# We hold a reference to each open stream's pip socket, and the bot state last checkpointed by its worker,
+		# so that we can resume the stream on another worker if its worker dies.
+		self._pip_socks = {} # {stream: pip socket}
+		self._checkpoints = {} # {stream: state}
+		self.codecs = main.config.ipc_codecs
+		self.placement_policy_name = main.config.placement_policy
+		self.placement_policy = POLICIES[self.placement_policy_name]
+		self.placements = 0 # count of streams placed
+		self.claims = 0 # count of streams accepted by workers themselves, see pip_reuseport
+		self._migrating = {} # {stream: (dest conn, [chat messages held until migration completes])}
+		self.migrations = 0 # count of completed migrations
+		self.resumptions = 0 # count of streams resumed after their worker died
+		self._chat_filters = {} # {stream: ChatFilter}, streams without one are sent all chat
+		self.chat_forwarded = 0 # count of chat messages sent to workers
+		self.chat_filtered = 0 # count of chat messages dropped as no feature would act on them
+		self.logger.info("Using {} stream placement policy".format(self.placement_policy_name))
 		self._conns_changed = Event()
-		for i in range(num_workers):
-			self.group.spawn(self._worker_proc_watchdog)
+		self.min_workers = min_workers
+		self.max_workers = max(min_workers, max_workers)
+		self.num_workers = 0 # number of workers we want running, not counting draining ones
+		if adopted:
+			self._adopt(*adopted)
+		for i in range(min_workers - self.num_workers):
+			self._add_worker()
+		self._start_background()
+
+	def _adopt(self, state, fds):
+		for stream, stream_state in state['streams'].items():
+			self._pip_socks[stream] = socket.fromfd(fds[stream_state['fd']], AF_INET, SOCK_STREAM)
+			if stream_state['checkpoint'] is not None:
+				self._checkpoints[stream] = stream_state['checkpoint']
+			if stream_state['chat_filter'] is not None:
+				self._chat_filters[stream] = ChatFilter(**stream_state['chat_filter'])
+		for conn_state in state['conns']:
+			sock = socket.fromfd(fds[conn_state['fd']], AF_UNIX, SOCK_STREAM)
+			conn = IPCMasterConnection(self, sock, adopted=conn_state, logger=self.logger)
+			self.conns[conn.name] = conn
+			for stream in conn.streams:
+				self._add_stream(stream, conn)
+			if not conn.draining:
+				self.num_workers += 1
+			self.group.spawn(self._adopted_worker_watchdog, conn)
+			conn.start()
+			self.logger.info("Adopted {} with streams {}".format(conn, conn.streams))
+		for stream, migration in state.get('migrating', {}).items():
+			held_chat = [tuple(args) for args in migration['held_chat']]
+			if stream in self._stream_conns:
+				# its worker will tell us when it has finished or failed to migrate
+				self._migrating[stream] = self.conns.get(migration['dest']), held_chat
+			elif self._can_resume(stream):
+				# it was being resumed after its worker died
+				self._migrating[stream] = None, held_chat
+				self._resumes.spawn(self._do_resume_stream, stream, time.time())
+			else:
+				# main isn't ready to be told yet, but it syncs irc with our streams once it is
+				self.logger.warning("Adopted stream {} is on no worker and can't be resumed, dropping it".format(stream))
+				self._checkpoints.pop(stream, None)
+				self._chat_filters.pop(stream, None)
+				pip_sock = self._pip_socks.pop(stream, None)
+				if pip_sock is not None:
+					pip_sock.close()
+
+	def _start_background(self):
+		if self.max_workers > self.min_workers:
+			self._background.spawn(self._autoscale_loop)
+		if self.main.config.rebalance_threshold is not None:
+			self._background.spawn(self._rebalance_loop)
+		for conn in self.conns.values():
+			if conn.draining:
+				# carry on draining it, eg. where a previous master left off
+				self._background.spawn(self._stop_when_empty, conn)
+
+	def hand_off(self, fds):
+		"""Pause all activity, without disturbing workers or streams, and return our state
+		to be passed to a new master. Any fds which must be passed along are appended to fds.
+		Once the new master has our state, call finish_hand_off(), or if it failed to take it,
+		cancel_hand_off() to carry on as before."""
+		self.stopping = True
+		self._accept_loop.kill(block=False)
+		self._background.kill(block=True)
+		if self._migrating:
+			self.logger.info("Waiting for {} streams to finish migrating before handoff".format(len(self._migrating)))
+			with gevent.Timeout(self.MIGRATE_TIMEOUT, False):
+				while self._migrating:
+					gevent.sleep(0.1)
+		# any resumes still going (eg. waiting for a worker to exist) are finished by the new master
+		self._resumes.kill(block=True)
+		if self._migrating:
+			self.logger.warning("Handing off {} streams that are still migrating".format(len(self._migrating)))
+
+		def add_fd(fileobj, family):
+			# dup, so our copy can close without affecting the one being passed
+			fds.append(socket.fromfd(fileobj.fileno(), family, SOCK_STREAM))
+			return len(fds) - 1
+
+		state = dict(
+			sock_path = self.sock_path,
+			listener = add_fd(self.listener, AF_UNIX),
+			streams = {
+				stream: dict(
+					fd = add_fd(pip_sock, AF_INET),
+					checkpoint = self._checkpoints.get(stream),
+					chat_filter = self._chat_filters[stream].describe() if stream in self._chat_filters else None,
+				)
+				for stream, pip_sock in self._pip_socks.items()
+			},
+			migrating = {
+				stream: dict(dest=dest.name if dest else None, held_chat=held_chat)
+				for stream, (dest, held_chat) in self._migrating.items()
+			},
+		)
+		with gevent.Timeout(self.HANDOFF_PAUSE_TIMEOUT):
+			state['conns'] = [conn.hand_off(add_fd(conn._socket, AF_UNIX)) for conn in self.conns.values()]
+		return state
+
+	def finish_hand_off(self):
+		"""Leave our workers and streams to the new master that took our state from hand_off().
+		We are unusable afterwards."""
+		self.handed_off = True
+		for conn in self.conns.values():
+			conn.finish_hand_off()
+		if self.zygote:
+			self.zygote.stop()
+
+	def cancel_hand_off(self):
+		"""Carry on as before hand_off(), as no new master took our state"""
+		self.stopping = False
+		for conn in self.conns.values():
+			conn.resume()
+		self._accept_loop = self.group.spawn(self.run)
+		self._start_background()
+		# restart anything hand_off() interrupted which was left for the new master to finish
+		for conn in set(self._stream_conns.values()):
+			if self.conns.get(conn.name) is not conn:
+				self._resumes.spawn(self._resume_after_exit, conn)
+		for stream, (dest, held_chat) in self._migrating.items():
+			if dest is None and stream not in self._stream_conns:
+				if self._can_resume(stream):
+					self._resumes.spawn(self._do_resume_stream, stream, time.time())
+				else:
+					self._forget_stream(stream)
 
 	def run(self):
 		while not self.stopping:
@@ -44,60 +216,350 @@ class IPCServer(HasLogger):
 			IPCMasterConnection(self, sock, logger=self.logger).start()
 			# will insert itself into conns once it knows its name
 
+	def _add_worker(self):
+		self.num_workers += 1
+		self.group.spawn(self._worker_proc_watchdog)
+
+	def _drain_worker(self, conn):
+		"""Stop placing streams on conn, migrate its streams elsewhere, then stop it once it has none."""
+		self.logger.info("Draining {} with {} streams".format(conn, len(conn.streams)))
+		conn.draining = True
+		conn.send('stop accepting')
+		self.num_workers -= 1
+		self._drained_pids.add(conn.pid)
+		for stream in list(conn.streams):
+			self.migrate_stream(stream)
+		self._background.spawn(self._stop_when_empty, conn)
+
+	def _stop_when_empty(self, conn):
+		deadline = time.time() + self.DRAIN_TIMEOUT
+		last_tried = time.time()
+		while conn.streams and time.time() < deadline:
+			gevent.sleep(self.DRAIN_CHECK_INTERVAL)
+			if self.conns.get(conn.name) is not conn:
+				return # the worker died while draining, its streams have already been dealt with
+			if time.time() - last_tried >= self.DRAIN_RETRY_INTERVAL:
+				last_tried = time.time()
+				for stream in list(conn.streams):
+					if stream not in self._migrating:
+						self.migrate_stream(stream)
+		if conn.streams:
+			# as when a worker dies, the streams are resumed elsewhere if possible,
+			# but not until it has exited and so stopped reading their pip connections
+			self.logger.warning("Stopping drained {} with {} streams that failed to migrate".format(conn, len(conn.streams)))
+			conn.resume_after_exit = True
+		else:
+			self.logger.info("Stopping drained {}".format(conn))
+		conn.stop() # the worker exits cleanly, so its watchdog won't respawn it
+
+	def _resume_after_exit(self, conn):
+		"""Resume or forget a stopped conn's streams once its worker process has exited,
+		killing it if it doesn't exit within WORKER_EXIT_TIMEOUT."""
+		for stream in conn.streams:
+			# hold their chat until they're resumed
+			dest, held_chat = self._migrating.get(stream, (None, []))
+			self._migrating[stream] = None, held_chat
+		deadline = time.time() + self.WORKER_EXIT_TIMEOUT
+		killed = False
+		while True:
+			try:
+				os.kill(conn.pid, 0)
+			except OSError:
+				break # no such process
+			if not killed and time.time() >= deadline:
+				self.logger.warning("{} did not exit after being stopped, killing it".format(conn))
+				try:
+					os.kill(conn.pid, signal.SIGKILL)
+				except OSError:
+					pass
+				killed = True
+			gevent.sleep(self.DRAIN_CHECK_INTERVAL)
+		self.logger.info("{} has exited, resuming its {} streams".format(conn, len(conn.streams)))
+		conn.release_streams(resume=True)
+
+	def _autoscale_loop(self):
+		"""Add a worker when the average per-worker cpu or stream count is above its high-water mark,
+		or drain the least busy worker if the averages would still be below their low-water marks without it.
+		Waits scale_cooldown seconds after any change for load samples to reflect it."""
+		config = self.main.config
+		last_scaled = time.time()
+		while True:
+			gevent.sleep(config.load_report_interval)
+			conns = self.active_conns
+			if not conns or time.time() - last_scaled < config.scale_cooldown:
+				continue
+			cpu = sum(conn.load.get('cpu', 0) for conn in conns)
+			streams = sum(len(conn.streams) for conn in conns)
+			if self.num_workers < self.max_workers and (
+				cpu / len(conns) > config.scale_up_cpu
+				or streams / float(len(conns)) > config.scale_up_streams
+			):
+				self.logger.info("Scaling up from {} workers: cpu {:.2f}, {} streams".format(self.num_workers, cpu, streams))
+				self._add_worker()
+				last_scaled = time.time()
+			elif self.num_workers > self.min_workers and len(conns) > 1 and (
+				cpu / (len(conns) - 1) < config.scale_down_cpu
+				and streams / float(len(conns) - 1) < config.scale_down_streams
+			):
+				self.logger.info("Scaling down from {} workers: cpu {:.2f}, {} streams".format(self.num_workers, cpu, streams))
+				self._drain_worker(min(conns, key=lambda conn: (len(conn.streams), conn.load.get('cpu', 0))))
+				last_scaled = time.time()
+
+	def _adopted_worker_watchdog(self, conn):
+		"""We can't wait on the process of a worker adopted from a previous master, as it isn't our child.
+		Instead we wait for its connection to stop, then replace it as normal."""
+		try:
+			conn.wait_for_stop()
+		except Exception:
+			pass
+		if self.stopping or conn.draining:
+			return
+		self.logger.error("Connection to adopted worker {} died".format(conn))
+		self._worker_proc_watchdog()
+
 	def _worker_proc_watchdog(self):
 		while True:
-			proc = None
 			self.logger.info("Starting worker process")
+			started = time.time()
 			try:
-				proc = subprocess.Popen([
-					sys.executable,
-					'-m', 'pipirc.worker',
-					self.main.config.filepath, self.sock_path,
-				])
-				proc.wait()
+				if self.zygote and self.zygote.running:
+					pid, returncode = self._run_forked_worker()
+				else:
+					pid, returncode = self._run_subprocess_worker()
 			except Exception:
-				self.logger.exception("Error starting or waiting on subprocess")
+				self.logger.exception("Error starting or waiting on worker process")
 			else:
-				if proc.returncode == 0:
+				if returncode == 0:
 					self.logger.info("Worker cleanly shut down")
 					return
-				self.logger.error("Subprocess died with exit code {}".format(proc.returncode))
-			finally:
-				if proc and proc.returncode is None:
-					try:
-						proc.kill()
-					except OSError:
-						pass
-			gevent.sleep(self.WORKER_RESPAWN_INTERVAL * random.uniform(0.9, 1.1))
+				self.logger.error("Worker died with exit code {}".format(returncode))
+				if pid in self._drained_pids:
+					# it isn't counted in num_workers any more, so mustn't be replaced
+					self._drained_pids.discard(pid)
+					return
+			# respawn immediately after a one-off crash, but don't spin if we're crashing repeatedly
+			if time.time() - started < self.WORKER_MIN_UPTIME:
+				gevent.sleep(self.WORKER_RESPAWN_INTERVAL * random.uniform(0.9, 1.1))
+
+	def _run_subprocess_worker(self):
+		"""Run a worker as a new python process, returning (pid, exit code)"""
+		proc = None
+		try:
+			proc = subprocess.Popen([
+				sys.executable,
+				'-m', 'pipirc.worker',
+				self.main.config.filepath, self.sock_path,
+			])
+			return proc.pid, proc.wait()
+		finally:
+			# if we've handed off, the worker belongs to the new master now
+			if proc and proc.returncode is None and not self.handed_off:
+				try:
+					proc.kill()
+				except OSError:
+					pass
+
+	def _run_forked_worker(self):
+		"""Run a worker forked from the zygote, returning (pid, exit code)"""
+		pid = self.zygote.spawn()
+		returncode = None
+		try:
+			returncode = self.zygote.wait(pid)
+			return pid, returncode
+		finally:
+			if returncode is None and not self.handed_off:
+				try:
+					os.kill(pid, signal.SIGKILL)
+				except OSError:
+					pass
 
 	@property
 	def streams_to_conns(self):
-		ret = {}
+		"""Map {stream: conn} of all connected streams. Do not modify."""
+		return self._stream_conns
+
+	@property
+	def streams(self):
+		"""Set of all connected streams, including any currently moving between conns"""
+		if not self._migrating:
+			return self._stream_conns.viewkeys()
+		return self._stream_conns.viewkeys() | self._migrating.viewkeys()
+
+	def is_open(self, stream):
+		return stream in self._stream_conns or stream in self._migrating
+
+	def _add_stream(self, stream, conn):
+		assert stream not in self._stream_conns, "Stream {} opened on {} but already open on {}".format(
+			stream, conn, self._stream_conns[stream],
+		)
+		self._stream_conns[stream] = conn
+
+	def _remove_stream(self, stream, conn):
+		assert self._stream_conns.get(stream) is conn, "Stream {} closed on {} but open on {}".format(
+			stream, conn, self._stream_conns.get(stream),
+		)
+		del self._stream_conns[stream]
+
+	def check_consistency(self):
+		"""Assert that the stream index matches the streams each conn says it has"""
+		expected = {}
 		for conn in self.conns.values():
 			for stream in conn.streams:
-				assert stream not in ret
-				ret[stream] = conn
-		return ret
+				assert stream not in expected, "Stream {} open on both {} and {}".format(stream, expected[stream], conn)
+				expected[stream] = conn
+		assert expected == self._stream_conns, "Stream index {!r} does not match conns {!r}".format(
+			self._stream_conns, expected,
+		)
 
 	@property
-	def streams(self):
-		"""Set of all connected streams"""
-		return set(self.streams_to_conns.keys())
+	def active_conns(self):
+		"""List of conns which may be given new streams"""
+		return [conn for conn in self.conns.values() if not conn.draining]
 
 	def _choose_conn(self):
 		"""Pick a conn to be given a new stream."""
 		# wait for at least one conn to exist
-		while not self.conns:
+		while not self.active_conns:
 			self._conns_changed.wait()
-		# approximate least loaded as least streams
-		return min(self.conns.values(), key=lambda conn: len(conn.streams))
+		return self.placement_policy(self.active_conns)
 
 	def open_stream(self, stream, pip_sock):
+		if self.stopping:
+			# eg. paused for a handoff, which it would miss
+			raise Exception("Not opening stream {} while stopping".format(stream))
 		conn = self._choose_conn()
+		self.placements += 1
+		self.logger.info("Placing stream {} onto conn {} by {} policy (streams: {}, load: {})".format(
+			stream, conn, self.placement_policy_name, len(conn.streams), conn.load,
+		))
 		conn.open_stream(stream, pip_sock)
 		self.logger.debug("Opening new stream {} onto conn {} with sock {}".format(stream, conn, pip_sock))
 
+	def claim_stream(self, stream, conn):
+		"""Register a stream whose pip connection was accepted by conn's worker, if allowed.
+		Returns whether it was."""
+		if self.stopping or conn.draining or self.is_open(stream) or stream not in self.main.streams:
+			return False
+		self.claims += 1
+		self.logger.info("Stream {} accepted by conn {} (streams: {}, load: {})".format(
+			stream, conn, len(conn.streams), conn.load,
+		))
+		self._add_stream(stream, conn)
+		conn.streams.add(stream)
+		self.main.stream_opened(stream)
+		return True
+
+	def migrate_stream(self, stream, dest=None):
+		"""Move a stream to the dest conn, or to one chosen by placement policy, without the
+		pip connection being interrupted. Returns immediately, the move completes once the current worker
+		has stopped the stream and handed it back to us."""
+		source = self._stream_conns[stream]
+		if stream in self._migrating:
+			self.logger.info("Not migrating stream {}, already migrating".format(stream))
+			return
+		if dest is None:
+			candidates = [conn for conn in self.active_conns if conn is not source]
+			if not candidates:
+				self.logger.info("Not migrating stream {}, no other conns".format(stream))
+				return
+			dest = self.placement_policy(candidates)
+		self.logger.info("Migrating stream {} from {} to {}".format(stream, source, dest))
+		self._migrating[stream] = dest, []
+		source.send('migrate stream', stream=stream, timeout=self.MIGRATE_TIMEOUT)
+
+	def _finish_migration(self, stream, pip_sock, state):
+		# a stream can finish migrating without us knowing it started, if it started under a previous master
+		dest, held_chat = self._migrating.get(stream, (None, []))
+		if dest is None or dest.name not in self.conns or dest.draining:
+			if dest is not None:
+				self.logger.warning("Migration target {} for stream {} went away, picking another".format(dest, stream))
+			dest = self._choose_conn()
+		self._migrating.pop(stream, None)
+		self._checkpoints[stream] = state
+		dest.open_stream(stream, pip_sock, state=state)
+		self.migrations += 1
+		self.logger.info("Migrated stream {} to {}".format(stream, dest))
+		for args in held_chat:
+			dest.recv_chat(*args)
+
+	def _can_resume(self, stream):
+		return stream in self._pip_socks and stream in self._checkpoints
+
+	def _resume_stream(self, stream):
+		"""Re-open a stream whose worker has died on another worker,
+		using the pip socket and last checkpoint we hold for it."""
+		# keep any chat held by a migration that was interrupted by the worker dying
+		dest, held_chat = self._migrating.get(stream, (None, []))
+		self._migrating[stream] = None, held_chat
+		self._resumes.spawn(self._do_resume_stream, stream, time.time())
+
+	def _do_resume_stream(self, stream, started):
+		self.logger.info("Resuming stream {} from checkpoint".format(stream))
+		self._finish_migration(stream, self._pip_socks[stream], self._checkpoints[stream])
+		self.resumptions += 1
+		self.logger.info("Resumed stream {} after {:.3f}s".format(stream, time.time() - started))
+
+	def _forget_stream(self, stream):
+		"""Drop everything we hold for a closed stream"""
+		self._migrating.pop(stream, None)
+		self._checkpoints.pop(stream, None)
+		if self._chat_filters.pop(stream, None):
+			self.main.chat_filter_changed(stream, None)
+		pip_sock = self._pip_socks.pop(stream, None)
+		if pip_sock is not None:
+			pip_sock.close()
+		self.main.stream_closed(stream)
+
+	def _abort_migration(self, stream):
+		if stream not in self._migrating:
+			return
+		dest, held_chat = self._migrating.pop(stream)
+		conn = self._stream_conns.get(stream)
+		self.logger.warning("Failed to migrate stream {} to {}, remains on {}".format(stream, dest, conn))
+		if conn:
+			for args in held_chat:
+				conn.recv_chat(*args)
+
+	def _rebalance_loop(self):
+		"""When the difference in cpu usage between the most and least loaded workers exceeds
+		rebalance_threshold, move the stream with the highest pip update rate from the most to least loaded."""
+		while True:
+			gevent.sleep(self.main.config.rebalance_interval)
+			conns = [conn for conn in self.active_conns if conn.load]
+			if len(conns) < 2 or self._migrating:
+				continue
+			hot = max(conns, key=lambda conn: conn.load['cpu'])
+			cold = min(conns, key=lambda conn: conn.load['cpu'])
+			skew = hot.load['cpu'] - cold.load['cpu']
+			if skew < self.main.config.rebalance_threshold or len(hot.streams) < 2:
+				continue
+			rates = hot.load.get('stream_pip_update_rates', {})
+			stream = max(hot.streams, key=lambda stream: rates.get(stream, 0))
+			self.logger.info("Rebalancing: cpu skew {:.2f} between {} and {}".format(skew, hot, cold))
+			self.migrate_stream(stream, cold)
+
+	def set_chat_filter(self, stream, commands, patterns, match_all):
+		try:
+			self._chat_filters[stream] = ChatFilter(commands, patterns, match_all)
+		except Exception:
+			self.logger.warning("Bad chat filter for stream {}, sending it all chat".format(stream), exc_info=True)
+			self._chat_filters.pop(stream, None)
+		self.main.chat_filter_changed(stream, self._chat_filters.get(stream))
+
+	def wants_chat(self, stream, text):
+		"""Returns whether a chat message might be acted on by the stream's worker,
+		ie. whether it should be passed to recv_chat(). This is called before the message is fully parsed."""
+		chat_filter = self._chat_filters.get(stream)
+		if chat_filter and not chat_filter.matches(text):
+			self.chat_filtered += 1
+			return False
+		return True
+
 	def recv_chat(self, stream, text, sender, sender_rank):
+		self.chat_forwarded += 1
+		if stream in self._migrating:
+			self._migrating[stream][1].append((stream, text, sender, sender_rank))
+			return
 		conn = self.streams_to_conns.get(stream)
 		self.logger.debug("Got chat message for stream {} (conn {}): {}({}) says {!r}".format(
 			stream, conn, sender, sender_rank, text
@@ -110,16 +572,108 @@ class IPCServer(HasLogger):
 		"""Gracefully stop all workers. Blocks until all workers have completely stopped."""
 		self.stopping = True
 		self._accept_loop.kill(block=False)
+		self._background.kill(block=False)
+		self._resumes.kill(block=False)
 		self.logger.debug("Waiting for workers to stop")
 		gmap(lambda conn: conn.stop(), self.conns.values())
 		self.group.join()
+		if self.zygote:
+			self.zygote.stop()
+
+
+class MessageBatcher(object):
+	"""Buffers messages to be sent on an IPCConnection, then sends them together as one 'batch' message
+	once max_size messages are pending or the oldest has waited max_delay seconds.
+	Counts batch sizes and the latency added by batching in stats."""
+
+	def __init__(self, conn, max_size, max_delay):
+		self.conn = conn
+		self.max_size = max_size
+		self.max_delay = max_delay
+		self.pending = [] # [(time enqueued, msg)]
+		self._flush_timer = None
+		self.stats = {
+			'batches': 0,
+			'messages': 0,
+			'max_batch_size': 0,
+			'total_delay': 0.0,
+			'max_delay': 0.0,
+		}
+
+	@property
+	def enabled(self):
+		return self.max_size > 1 and self.max_delay > 0
+
+	def add(self, msg):
+		self.pending.append((time.time(), msg))
+		if len(self.pending) >= self.max_size:
+			self.flush()
+		elif self._flush_timer is None:
+			self._flush_timer = gevent.spawn_later(self.max_delay, self.flush)
+
+	def flush(self):
+		"""Immediately enqueue all pending messages to be sent"""
+		timer, self._flush_timer = self._flush_timer, None
+		if timer is not None and timer is not gevent.getcurrent():
+			timer.kill(block=False)
+		if not self.pending:
+			return
+		pending, self.pending = self.pending, []
+
+		now = time.time()
+		delay = now - pending[0][0]
+		self.stats['batches'] += 1
+		self.stats['messages'] += len(pending)
+		self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(pending))
+		self.stats['total_delay'] += sum(now - queued for queued, msg in pending)
+		self.stats['max_delay'] = max(self.stats['max_delay'], delay)
+
+		if len(pending) == 1:
+			(queued, msg), = pending
+			self.conn._enqueue(msg)
+		else:
+			self.conn._enqueue({'type': 'batch', 'messages': [msg for queued, msg in pending]})
+
+	def discard(self):
+		"""Drop all pending messages without sending"""
+		if self._flush_timer is not None:
+			self._flush_timer.kill(block=False)
+			self._flush_timer = None
+		self.pending = []
+
+
+class _Paused(Exception):
+	"""Thrown into a connection's receive loop to stop it reading, see IPCConnection.pause()"""
 
 
 class IPCConnection(HasLogger, GSocketClient):
+	RECV_SIZE = 64 * 1024
+
+	# message types which may be delayed to be sent as part of a batch
+	BATCHED_TYPES = {'chat message'}
+
 	name = None
 
-	def __init__(self, socket, logger=None):
+	def __init__(self, socket, batch_size=1, batch_delay=0, logger=None):
+		"""Chat messages are batched for up to batch_delay seconds or batch_size messages,
+		whichever comes first. Set either to 0 to disable batching."""
 		self._socket = socket
+		self.batcher = MessageBatcher(self, batch_size, batch_delay)
+		# All connections start out speaking json, and may switch codecs after the init handshake.
+		# Each direction switches independently: the sender switches immediately after sending a 'codec' message,
+		# and the receiver switches immediately after receiving it.
+		self._send_codec = CODECS['json']
+		self._recv_codec = CODECS['json']
+		# bytes recieved but not yet decoded start at _recv_buf[_recv_pos:]
+		self._recv_buf = ''
+		self._recv_pos = 0
+		# see pause()
+		self._resumed = Event()
+		self._resumed.set()
+		self._parked = Event() # set while the receive loop is waiting to be resumed
+		self._receiver = None # the receive loop, while it is waiting for data
+		self._pausing = False # whether a _Paused is on its way to the receive loop
+		self._held_sends = None # messages sent while paused, to be sent on resume()
 		super(IPCConnection, self).__init__(logger=logger)
 
 	def __repr__(self):
@@ -130,8 +684,20 @@ class IPCConnection(HasLogger, GSocketClient):
 		"""Send message of given type, with other args.
 		Set 'fd' to an integer fd to send that fd over the wire."""
 		data['type'] = type
-		self.logger.debug("Enqueuing {} to be sent".format(data))
-		return super(IPCConnection, self).send(data, block=block)
+		if type in self.BATCHED_TYPES and self.batcher.enabled and not block:
+			self.batcher.add(data)
+			return
+		# anything else must not overtake messages that are still waiting to be batched
+		self.batcher.flush()
+		return self._enqueue(data, block=block)
+
+	def _enqueue(self, msg, block=False):
+		if self._held_sends is not None:
+			self.logger.debug("Holding {} until resumed".format(msg))
+			self._held_sends.append(msg)
+			return
+		self.logger.debug("Enqueuing {} to be sent".format(msg))
+		return super(IPCConnection, self).send(msg, block=block)
 
 	def _send(self, msg):
 		self.logger.debug("Sending {}".format(msg))
@@ -143,15 +709,76 @@ class IPCConnection(HasLogger, GSocketClient):
 		super(IPCConnection, self)._send(msg)
 		if msg.get('fd') is not None:
 			send_fd(self._socket, msg['fd'])
+		if msg['type'] == 'codec':
+			self._send_codec = CODECS[msg['name']]
 
 	def _encode(self, msg):
-		return json.dumps(msg) + '\n'
+		return self._send_codec.encode(msg)
+
+	def pause(self):
+		"""Stop reading and handling messages, once any being handled is done, and hold any we send
+		until resume(). The connection itself is left untouched, so another process may take it over."""
+		self._held_sends = []
+		self._resumed.clear()
+		if self._receiver is not None:
+			self._pausing = True
+			gevent.kill(self._receiver, _Paused)
+		while self._pausing or not self._parked.is_set():
+			gevent.sleep(0.01)
+
+	def resume(self):
+		held, self._held_sends = self._held_sends or [], None
+		self._resumed.set()
+		for msg in held:
+			self._enqueue(msg)
+
+	def _park(self):
+		self._parked.set()
+		try:
+			self._resumed.wait()
+		except _Paused:
+			self._pausing = False
+		finally:
+			self._parked.clear()
+
+	def _recv(self):
+		"""Returns data read from our socket, or None if interrupted by pause()"""
+		self._receiver = gevent.getcurrent()
+		try:
+			return self._socket.recv(self.RECV_SIZE)
+		except _Paused:
+			self._pausing = False
+			return None
+		finally:
+			self._receiver = None
+
+	def _receive(self):
+		while True:
+			if not self._resumed.is_set():
+				self._park()
+				continue
+			# note we must decode one message at a time, as handling a message may change the codec
+			msg, self._recv_pos = self._recv_codec.decode(self._recv_buf, self._recv_pos)
+			if msg is not None:
+				self._handle(msg)
+				continue
+			data = self._recv()
+			if data is None:
+				continue
+			if not data:
+				self.logger.info("IPC connection closed by remote end")
+				self.stop()
+				return
+			self._recv_buf = self._recv_buf[self._recv_pos:] + data
+			self._recv_pos = 0
 
 	def _handle(self, msg):
-		msg = json.loads(msg)
 		if 'fd' in msg:
 			msg['fd'] = recv_fd(self._socket)
 		self.logger.debug("Recieved {}".format(msg))
+		self._dispatch(msg)
+
+	def _dispatch(self, msg):
 		msg_type = msg.pop('type')
 		if msg_type in self._handle_map:
 			try:
@@ -159,88 +786,464 @@ class IPCConnection(HasLogger, GSocketClient):
 			except Exception:
 				self.logger.exception("Failed to process IPC request of type {!r} with args {!r}".format(msg_type, msg))
 
+	def _choose_codec(self, ours, theirs):
+		"""Switch to sending with our most preferred codec that the remote end also supports.
+		json is always supported."""
+		codec = next((codec for codec in ours if codec in theirs), 'json')
+		self.logger.debug("Using {} codec for conn {}".format(codec, self))
+		if codec != self._send_codec.name:
+			self.send('codec', name=codec)
+
+	def _codec(self, name):
+		"""Remote end has switched to sending with the named codec"""
+		self.logger.debug("Remote end switched to {} codec".format(name))
+		self._recv_codec = CODECS[name]
+
+	def _batch(self, messages):
+		for msg in messages:
+			self._dispatch(msg)
+
+	def _stop(self, ex=None):
+		self.batcher.discard()
+		super(IPCConnection, self)._stop()
+
 
 class IPCMasterConnection(IPCConnection):
-	def __init__(self, server, socket, logger=None):
-		super(IPCMasterConnection, self).__init__(socket, logger=logger)
+	draining = False # when set, no new streams will be placed on this conn
+	resume_after_exit = False # when set, our streams aren't resumed when we stop until our worker has exited
+
+	def __init__(self, server, socket, adopted=None, logger=None):
+		"""If adopted is given, it is the state of a conn handed off by a previous master."""
+		super(IPCMasterConnection, self).__init__(
+			socket,
+			batch_size=server.main.config.ipc_batch_size,
+			batch_delay=server.main.config.ipc_batch_delay,
+			logger=logger,
+		)
 		self.server = server
 		self.streams = set() # set of streams handled by the worker we're connected to
+		self.load = {} # most recent load sample reported by worker
+		self.load_time = None # when we got it
 		self._handle_map = {
+			'batch': self._batch,
+			'chat filter': self._chat_filter,
 			'chat message': self._send_chat,
+			'checkpoint': self._checkpoint,
+			'checkpoint stale': self._checkpoint_stale,
+			'claim stream': self._claim_stream,
 			'close stream': self._close_stream,
+			'codec': self._codec,
 			'init': self._init,
+			'load': self._load,
+			'migrate failed': self._migrate_failed,
+			'stream migrated': self._stream_migrated,
+			'stream socket': self._stream_socket,
 		}
+		if adopted:
+			self.name = adopted['name']
+			self.streams = set(adopted['streams'])
+			self.load = adopted['load']
+			self.draining = adopted['draining']
+			self._send_codec = CODECS[adopted['send_codec']]
+			self._recv_codec = CODECS[adopted['recv_codec']]
+			self._recv_buf = base64.b64decode(adopted['recv_buf'])
+
+	def hand_off(self, fd_index):
+		"""Pause without disturbing the worker, and return our state for a new master.
+		fd_index is the index of our socket in the fds being handed off.
+		Afterwards, either finish_hand_off() or resume()."""
+		# wait until everything we've queued has been sent
+		self.send('master handoff', block=True)
+		self.pause()
+		return dict(
+			fd = fd_index,
+			name = self.name,
+			streams = list(self.streams),
+			load = self.load,
+			draining = self.draining,
+			send_codec = self._send_codec.name,
+			recv_codec = self._recv_codec.name,
+			recv_buf = base64.b64encode(self._recv_buf[self._recv_pos:]),
+		)
+
+	def finish_hand_off(self):
+		"""Stop for good once a new master has our state, dropping anything sent since hand_off()"""
+		self._held_sends = []
+		self.group.kill(block=True)
 
 	def _stop(self, ex=None):
 		super(IPCMasterConnection, self)._stop()
+		if self.server.handed_off:
+			return # our worker and streams belong to the new master
+		# if we didn't ask the worker to stop, it died and we should try to resume its streams elsewhere
+		resume = not self.server.stopping
 		for stream in self.streams:
-			self._send_chat(stream, "Something went wrong. Attempting to reconnect...")
+			if not (resume and self.server._can_resume(stream)):
+				self._send_chat(stream, "Something went wrong. Attempting to reconnect...", priority='error')
 		if self.name is not None:
 			assert self.server.conns.pop(self.name) is self
-		self.server.main.sync_streams()
+			if resume and self.resume_after_exit and self.streams:
+				self.server._resumes.spawn(self.server._resume_after_exit, self)
+			else:
+				self.release_streams(resume)
+
+	def release_streams(self, resume):
+		"""Once stopped, resume our streams elsewhere if resume is set and we can, otherwise forget them"""
+		for stream in self.streams:
+			self.server._remove_stream(stream, self)
+			if resume and self.server._can_resume(stream):
+				self.server._resume_stream(stream)
+			else:
+				self.server._forget_stream(stream)
+
+	@property
+	def pid(self):
+		"""The worker's pid, which workers put at the start of their name (see pipirc.worker:run)"""
+		return int(self.name.split(':', 1)[0]) if self.name else None
 
-	def _init(self, name):
+	def _init(self, name, codecs=('json',)):
 		if self.server.stopping:
 			self.stop()
 		else:
 			self.name = name
+			self._choose_codec(self.server.codecs, codecs)
 			self.server.conns[name] = self
 			# set then immediately reset so new waiters can wait
 			self.server._conns_changed.set()
 			self.server._conns_changed = Event()
 
-	def open_stream(self, stream, pip_fd):
+	def _load(self, **sample):
+		self.load = sample
+		self.load_time = time.time()
+
+	def open_stream(self, stream, pip_fd, state=None):
 		"""Send stream info and pip protocol fd for given stream to worker process,
-		assigning the stream to this process."""
+		assigning the stream to this process. State is passed when resuming a migrated stream."""
+		self.server._add_stream(stream, self)
 		self.streams.add(stream)
-		self.server.main.sync_streams()
-		self.send('open stream', stream=stream, fd=pip_fd)
+		self.server._pip_socks[stream] = pip_fd
+		self.server.main.stream_opened(stream)
+		if state is None:
+			self.send('open stream', stream=stream, fd=pip_fd)
+		else:
+			self.send('open stream', stream=stream, fd=pip_fd, state=state)
+
+	def _claim_stream(self, stream):
+		self.send('claim result', stream=stream, ok=self.server.claim_stream(stream, self))
+
+	def _stream_socket(self, stream, fd):
+		"""Worker has sent us a copy of the pip socket for a stream it accepted itself,
+		so we can resume the stream elsewhere if it dies"""
+		# fromfd() dups, so we need to close the original
+		pip_sock = socket.fromfd(fd, AF_INET, SOCK_STREAM)
+		os.close(fd)
+		if stream in self.streams:
+			self.server._pip_socks[stream] = pip_sock
+		else:
+			pip_sock.close() # already closed or moved
 
 	def _close_stream(self, stream):
 		self.streams.remove(stream)
-		self.server.main.sync_streams()
+		self.server._remove_stream(stream, self)
+		self.server._forget_stream(stream)
+
+	def _checkpoint(self, stream, state):
+		if stream in self.streams:
+			self.server._checkpoints[stream] = state
+
+	def _checkpoint_stale(self, stream):
+		if stream in self.streams:
+			self.server._checkpoints.pop(stream, None)
+		self.send('checkpoint dropped', stream=stream)
+
+	def _chat_filter(self, stream, commands, patterns, match_all):
+		if stream in self.streams:
+			self.server.set_chat_filter(stream, commands, patterns, match_all)
+
+	def _stream_migrated(self, stream, fd, state):
+		# fromfd() dups, so we need to close the original
+		pip_sock = socket.fromfd(fd, AF_INET, SOCK_STREAM)
+		os.close(fd)
+		# we don't close the stream's chat as the stream will be immediately re-opened on another conn
+		self.streams.remove(stream)
+		self.server._remove_stream(stream, self)
+		self.server._finish_migration(stream, pip_sock, state)
 
-	def _send_chat(self, stream, text):
-		self.server.main.send_chat(stream, text)
+	def _migrate_failed(self, stream):
+		self.server._abort_migration(stream)
+
+	def _send_chat(self, stream, text, priority='reply'):
+		self.server.main.send_chat(stream, text, priority)
 
 	def recv_chat(self, stream, text, sender, sender_rank):
 		self.send('chat message', stream=stream, text=text, sender=sender, sender_rank=sender_rank)
 
 
 class IPCWorkerConnection(IPCConnection):
+	CLAIM_TIMEOUT = 10 # how long to wait for the master to answer a claim stream request
+	CHECKPOINT_STALE_TIMEOUT = 10 # how long to wait for the master to drop a stale checkpoint
+	# cumulative PippyBot counters included in load reports, see sample_load()
+	BOT_COUNTERS = (
+		'pip_updates', 'pip_dispatches', 'update_callbacks_called', 'update_callbacks_skipped',
+		'view_cache_hits', 'view_cache_misses',
+	)
+
+	pip_server = None
+
 	def __init__(self, name, sock_path, config, logger=None):
 		self.name = name
 		self.streams = {} # {stream: PippyBot}
 		self.config = config
+		self._closed_counts = {counter: 0 for counter in self.BOT_COUNTERS} # totals from bots no longer in streams
+		self._claims = {} # {stream: AsyncResult}, claim stream requests awaiting the master's answer
+		self._stale_checkpoints = {} # {stream: AsyncResult}, checkpoint stale notices awaiting the master's answer
 		self._handle_map = {
+			'batch': self._batch,
 			'open stream': self._open_stream,
 			'chat message': self._recv_chat,
+			'checkpoint dropped': self._checkpoint_dropped,
+			'claim result': self._claim_result,
+			'codec': self._codec,
+			'migrate stream': self._migrate_stream,
+			'master handoff': self._master_handoff,
+			'stop accepting': self._stop_accepting,
 		}
 
 		sock = socket.socket(AF_UNIX, SOCK_STREAM)
 		sock.connect(sock_path)
-		super(IPCWorkerConnection, self).__init__(sock, logger=logger)
+		super(IPCWorkerConnection, self).__init__(
+			sock, batch_size=config.ipc_batch_size, batch_delay=config.ipc_batch_delay, logger=logger,
+		)
 
 		self.init(self.name)
 
 	def init(self, name):
-		self.send('init', name=name)
+		self.send('init', name=name, codecs=self.config.ipc_codecs)
+
+	def _start(self):
+		super(IPCWorkerConnection, self)._start()
+		self.group.spawn(self._report_load)
+		if self.config.checkpoint_interval:
+			self.group.spawn(self._checkpoint_loop)
+		if self.config.pip_reuseport:
+			self._pip_keys = PipKeyIndex(self.config.streams.values())
+			self.pip_server = PipConnectionServer(self, self._bind_pip_listener(), logger=self.logger)
+			self.pip_server.start()
+
+	def _bind_pip_listener(self):
+		"""Bind the pip listen address alongside the master's other workers, which the kernel
+		then distributes incoming connections between"""
+		family, address = parse_address(self.config.listen)
+		sock = socket.socket(family, SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		# python 2's socket module lacks the constant, this is its value on linux
+		sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+		sock.bind(address)
+		sock.listen(self.config.pip_listen_backlog)
+		return sock
+
+	def _stop_accepting(self):
+		"""We're being drained, leave new connections to other workers"""
+		if self.pip_server:
+			self.logger.info("No longer accepting pip connections")
+			self.pip_server.close()
+
+	def get_stream_by_pip_key_constant_time(self, pip_key):
+		return self._pip_keys.get(pip_key)
+
+	def claim_stream(self, stream):
+		"""Ask the master to register stream as open on this worker, so it joins chat and the stream
+		can't be opened anywhere else. Blocks until the master answers, and returns whether it agreed."""
+		if stream in self.streams or stream in self._claims:
+			return False
+		result = self._claims[stream] = AsyncResult()
+		self.send('claim stream', stream=stream)
+		try:
+			return result.get(timeout=self.CLAIM_TIMEOUT)
+		finally:
+			del self._claims[stream]
+
+	def _claim_result(self, stream, ok):
+		if stream in self._claims:
+			self._claims[stream].set(ok)
+		elif ok:
+			# whoever asked gave up waiting, so give the stream back
+			self.send('close stream', stream=stream)
+
+	def release_stream(self, stream):
+		"""Give back a claimed stream that we failed to open"""
+		self.send('close stream', stream=stream)
+
+	def open_stream(self, stream_config, pip_sock):
+		"""Open a stream whose pip connection we accepted and claimed ourselves"""
+		if self.config.checkpoint_interval:
+			# the master needs its own reference to resume the stream if we die
+			self.send('stream socket', stream=stream_config.name, fd=pip_sock)
+		self._open_stream(stream_config.name, pip_sock.fileno())
+
+	def _checkpoint_loop(self):
+		"""Send the master the state of each bot that has had no pip updates for a checkpoint interval,
+		so it can resume the stream elsewhere if we die.
+		A resumed bot must start from exactly the pip data it had when the rest of the pip stream was still unread,
+		so a checkpoint is only taken while the bot's pip client is waiting for a new message, and is only good
+		until the bot next reads from its pip connection. Before it does, it waits for the master to discard it
+		(see PippyBot.mark_checkpointed()). Busy streams are never checkpointed, as they would be stale
+		almost immediately and pickling all their pip data each interval is expensive."""
+		seen = {} # {stream: pip updates as of last check}
+		while True:
+			gevent.sleep(self.config.checkpoint_interval)
+			for stream, bot in self.streams.items():
+				updates = bot.pip_updates
+				busy = seen.get(stream) != updates
+				seen[stream] = updates
+				if busy or not bot.ready or bot.checkpointed or not bot.between_messages:
+					continue
+				try:
+					state = bot.get_state()
+				except Exception:
+					self.logger.warning("Failed to get state of stream {} for checkpoint".format(stream), exc_info=True)
+					continue
+				# nothing may yield between getting the state and marking it, or we could miss an update
+				bot.mark_checkpointed()
+				self.send('checkpoint', stream=stream, state=state)
+			for stream in set(seen) - set(self.streams):
+				del seen[stream]
+
+	def checkpoint_stale(self, stream):
+		"""Tell the master to drop the stream's checkpoint, as it's about to read more pip data.
+		Blocks until the master has (or CHECKPOINT_STALE_TIMEOUT passes), so if we die after reading
+		the stream isn't resumed from a checkpoint that doesn't match what's left unread."""
+		result = self._stale_checkpoints[stream] = AsyncResult()
+		self.send('checkpoint stale', stream=stream)
+		try:
+			result.get(timeout=self.CHECKPOINT_STALE_TIMEOUT)
+		except gevent.Timeout:
+			self.logger.warning("Master did not confirm dropping checkpoint for stream {}, continuing anyway".format(stream))
+		finally:
+			self._stale_checkpoints.pop(stream, None)
 
-	def _open_stream(self, stream, fd):
+	def _checkpoint_dropped(self, stream):
+		if stream in self._stale_checkpoints:
+			self._stale_checkpoints[stream].set()
+
+	def _bot_total(self, counter):
+		"""Total of a counter in BOT_COUNTERS for all bots, past and present"""
+		return self._closed_counts[counter] + sum(getattr(bot, counter) for bot in self.streams.values())
+
+	def _bot_closed(self, bot):
+		for counter in self.BOT_COUNTERS:
+			self._closed_counts[counter] += getattr(bot, counter)
+
+	@property
+	def pip_updates(self):
+		"""Total pip updates recieved by all bots, past and present"""
+		return self._bot_total('pip_updates')
+
+	def sample_load(self):
+		"""Returns cumulative cpu time and BOT_COUNTERS, and current greenlet count, rss and max_merged_batches.
+		The master is sent the rate of change of the cumulative values."""
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		try:
+			with open('/proc/self/statm') as f:
+				rss = int(f.read().split()[1]) * resource.getpagesize()
+		except (IOError, ValueError, IndexError):
+			rss = usage.ru_maxrss * 1024 # peak rather than current, but better than nothing
+		sample = dict(
+			cpu = usage.ru_utime + usage.ru_stime,
+			stream_pip_updates = {stream: bot.pip_updates for stream, bot in self.streams.items()},
+			# counts greenlets running feature callbacks, which is where nearly all of ours come from
+			greenlets = sum(len(feature.group) for bot in self.streams.values() for feature in bot.features),
+			rss = rss,
+			max_merged_batches = max([bot.max_merged_batches for bot in self.streams.values()] or [0]),
+		)
+		for counter in self.BOT_COUNTERS:
+			sample[counter] = self._bot_total(counter)
+		return sample
+
+	def _report_load(self):
+		last_time = time.time()
+		last = self.sample_load()
+		while True:
+			gevent.sleep(self.config.load_report_interval)
+			now = time.time()
+			sample = self.sample_load()
+			interval = now - last_time
+			delta = {counter: sample[counter] - last[counter] for counter in self.BOT_COUNTERS}
+			view_cache_lookups = delta['view_cache_hits'] + delta['view_cache_misses']
+			self.send('load',
+				cpu = (sample['cpu'] - last['cpu']) / interval,
+				pip_update_rate = delta['pip_updates'] / interval,
+				stream_pip_update_rates = {
+					stream: (updates - last['stream_pip_updates'].get(stream, 0)) / interval
+					for stream, updates in sample['stream_pip_updates'].items()
+				},
+				greenlets = sample['greenlets'],
+				rss = sample['rss'],
+				pip_dispatch_rate = delta['pip_dispatches'] / interval,
+				# pip updates still pending at either end of the interval make this approximate
+				mean_merged_batches = (
+					delta['pip_updates'] / float(delta['pip_dispatches']) if delta['pip_dispatches'] else 0
+				),
+				max_merged_batches = sample['max_merged_batches'],
+				update_callbacks_called_rate = delta['update_callbacks_called'] / interval,
+				update_callbacks_skipped_rate = delta['update_callbacks_skipped'] / interval,
+				view_cache_hit_ratio = (
+					delta['view_cache_hits'] / float(view_cache_lookups) if view_cache_lookups else 0
+				),
+			)
+			last_time, last = now, sample
+
+	def _codec(self, name):
+		super(IPCWorkerConnection, self)._codec(name)
+		# confirm, so master knows everything we send from here on uses the new codec
+		self.send('codec', name=name)
+
+	def _open_stream(self, stream, fd, state=None):
 		pip_sock = socket.fromfd(fd, AF_INET, SOCK_STREAM)
 		try:
-			self.streams[stream] = PippyBot(self, pip_sock, stream, self.config.streams[stream], logger=self.logger)
+			self.streams[stream] = PippyBot(
+				self, pip_sock, stream, self.config.streams[stream], state=state, logger=self.logger,
+			)
 		except Exception:
 			self.logger.exception("Failed to init stream {}".format(stream))
 			self.send('close stream', stream=stream)
+			return
+		self.send('chat filter', stream=stream, **self.streams[stream].get_chat_filter())
+
+	def _master_handoff(self):
+		self.logger.info("Master is handing off to a new master process")
+
+	def _migrate_stream(self, stream, timeout):
+		# quiescing may take a while, don't block other messages
+		self.group.spawn(self._do_migrate_stream, stream, timeout)
+
+	def _do_migrate_stream(self, stream, timeout):
+		if stream not in self.streams:
+			self.send('migrate failed', stream=stream)
+			return
+		bot = self.streams[stream]
+		try:
+			pip_sock, state = bot.quiesce(timeout)
+		except Exception:
+			self.logger.warning("Failed to quiesce stream {} for migration".format(stream), exc_info=True)
+			self.send('migrate failed', stream=stream)
+			return
+		del self.streams[stream]
+		self._bot_closed(bot)
+		self.send('stream migrated', stream=stream, fd=pip_sock, state=state)
 
 	def close_stream(self, stream):
 		if stream in self.streams:
-			self.streams.pop(stream)
+			bot = self.streams.pop(stream)
+			self._bot_closed(bot)
 			self.send('close stream', stream=stream)
 
-	def send_chat(self, stream, text):
-		self.send('chat message', stream=stream, text=text)
+	def send_chat(self, stream, text, priority='reply'):
+		if priority == 'reply':
+			# leave out the default so the message keeps its compact encoding
+			self.send('chat message', stream=stream, text=text)
+		else:
+			self.send('chat message', stream=stream, text=text, priority=priority)
 
 	def _recv_chat(self, stream, text, sender, sender_rank):
 		if stream in self.streams:
@@ -250,6 +1253,8 @@ class IPCWorkerConnection(IPCConnection):
 
 	def _stop(self, ex=None):
 		super(IPCWorkerConnection, self)._stop()
+		if self.pip_server:
+			self.pip_server.close()
 
 		# since our connection is gone, treat the expected master state as having no streams
 		# this ensures we don't try to send any closes, etc.
@@ -1,9 +1,11 @@
 
 from collections import defaultdict
-from itertools import groupby
+import bisect
+import hashlib
+import random
 
 import gevent
-from gevent.event import AsyncResult
+from gevent.event import AsyncResult, Event
 from gevent.pool import Group
 from gevent.queue import Queue
 
@@ -12,6 +14,8 @@ from classtricks import HasLogger
 from backoff import Backoff
 from gclient import GClient
 
+from .ratelimit import AccountLimits, SendScheduler
+
 
 def get_sender_rank(channel, tags):
 	"""From twitch tags, return a string message sender rank"""
@@ -23,11 +27,42 @@ def get_sender_rank(channel, tags):
 	return 'viewer'
 
 
+class HashRing(object):
+	"""Consistent hashing of keys onto shards 0 to shards - 1, so that changing the number of shards
+	only moves the keys it has to."""
+
+	REPLICAS = 256 # points on the ring per shard, more gives a more even spread
+
+	def __init__(self, shards):
+		self.shards = shards
+		self._ring = sorted(
+			(self._hash('{}:{}'.format(shard, replica)), shard)
+			for shard in range(shards)
+			for replica in range(self.REPLICAS)
+		)
+		self._points = [point for point, shard in self._ring]
+
+	@staticmethod
+	def _hash(key):
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+	def get(self, key):
+		index = bisect.bisect(self._points, self._hash(key)) % len(self._ring)
+		return self._ring[index][1]
+
+
 class IRCHostsManager(HasLogger):
 	"""An abstraction around a group of irc clients that provide service to different irc servers.
-	Takes a set of (host, nick, oauth, channel) tuples and automatically manages one actual client
-	per unique (host, nick, oauth).
+	Streams are added and removed with (host, nick, oauth, channel), and we automatically manage actual clients
+	per unique (host, nick, oauth). The channels for each (host, nick, oauth) are spread across up to
+	connections_per_user clients, so no one connection carries all traffic for a popular user.
+	update_connections() resyncs everything from a complete set of streams, which is much more expensive
+	than add_stream() and remove_stream() so is only needed as an occasional consistency check.
 	Any PrivMsgs received will be passed to the given callback as (stream, text, sender, sender_rank)
+	If chat_filter is given, it is called with (stream, text) for each PrivMsg as soon as it arrives,
+	and only messages for which it returns True are fully processed and passed to callback.
 	Note we assume stream name = channel_name.lstrip('#')
 	"""
 	# NOTE on security: We can't re-use a client for the same (host, nick) with differing oauth
@@ -35,20 +70,25 @@ class IRCHostsManager(HasLogger):
 	# let unauthorized users in. In the unusual case where the same nick has more than one oauth
 	# provided and both work, it's a pessimization we can live with.
 
-	def __init__(self, callback, logger=None):
-		self.clients = {} # {(host, nick, oauth): client}
+	def __init__(self, callback, connections_per_user=1, chat_filter=None, logger=None):
+		self.clients = {} # {(host, nick, oauth, shard): client}
+		self.limits = {} # {(host, nick, oauth): AccountLimits}, shared by all clients for that user
 		self.streams = {} # {stream name: (host, nick, oauth, channel)}
+		self._ring = HashRing(connections_per_user)
 		self._stopping_clients = Group()
+		self._stopping_accounts = defaultdict(int) # {(host, nick, oauth): number of clients still stopping}
 		self.callback = callback
+		self.chat_filter = chat_filter
 		super(IRCHostsManager, self).__init__(logger=logger)
 
-	def send(self, name, msg):
+	def send(self, name, msg, priority='reply'):
+		"""Send msg to stream name's chat. priority is one of pipirc.ratelimit.PRIORITIES."""
 		if name not in self.streams:
 			# shouldn't be able to happen, unless a channel was closed without IPC server knowing?
 			self.logger.warning("Tried to send message for unknown stream {!r}: {!r}".format(name, msg))
 			return
 		host, nick, oauth, channel = self.streams[name]
-		self.clients[host, nick, oauth].send(channel, msg)
+		self.clients[host, nick, oauth, self._ring.get(channel)].send(channel, msg, priority)
 
 	def _recv(self, client, msg):
 		# prefer twitch display-name for correct capitalization/internationalization
@@ -58,38 +98,91 @@ class IRCHostsManager(HasLogger):
 		stream_name = msg.target.lstrip('#') # NOTE: we depend on channel name being #stream-name
 		self.callback(stream_name, msg.payload, sender, sender_rank)
 
+	def _filter(self, channel, text):
+		return self.chat_filter is None or self.chat_filter(channel.lstrip('#'), text)
+
+	def _client_key(self, host, nick, oauth, channel):
+		return host, nick, oauth, self._ring.get(channel)
+
+	def _start_client(self, key, channels):
+		host, nick, oauth, shard = key
+		self.logger.info("Starting new irc client {} for {}@{}".format(shard, nick, host))
+		if (host, nick, oauth) not in self.limits:
+			self.limits[host, nick, oauth] = AccountLimits(nick)
+		self.clients[key] = IRCClientManager(
+			host, nick, self._recv, self.limits[host, nick, oauth], channels=channels,
+			recv_filter=self._filter, password=oauth, twitch=True, logger=self.logger,
+		)
+		self.clients[key].start()
+
+	def _stop_client(self, key):
+		host, nick, oauth, shard = key
+		client = self.clients.pop(key)
+		self.logger.info("Client {}({}@{} {}) has no more connections, stopping".format(
+			client, nick, host, shard
+		))
+		client.update_channels(set()) # by setting to no channels, ensures client won't call recv callback
+		# a stopping client may still be sending, so keep its limits for any new client on the same account
+		self._stopping_accounts[key[:3]] += 1
+		self._stopping_clients.spawn(client.wait_and_stop).link(lambda greenlet: self._client_stopped(key[:3]))
+
+	def _client_stopped(self, account):
+		self._stopping_accounts[account] -= 1
+		if not self._stopping_accounts[account]:
+			del self._stopping_accounts[account]
+			if not any(other[:3] == account for other in self.clients):
+				self.limits.pop(account, None)
+
+	def add_stream(self, name, host, nick, oauth, channel):
+		"""Join the channel for a newly opened stream. Does nothing if it's already joined."""
+		if self.streams.get(name) == (host, nick, oauth, channel):
+			return
+		if name in self.streams:
+			self.remove_stream(name) # config changed
+		self.streams[name] = host, nick, oauth, channel
+		key = self._client_key(host, nick, oauth, channel)
+		if key in self.clients:
+			self.clients[key].add_channels({channel})
+		else:
+			self._start_client(key, {channel})
+
+	def remove_stream(self, name):
+		"""Leave the channel for a closed stream"""
+		if name not in self.streams:
+			return
+		host, nick, oauth, channel = self.streams.pop(name)
+		key = self._client_key(host, nick, oauth, channel)
+		client = self.clients[key]
+		if client.channels == {channel}:
+			self._stop_client(key)
+		else:
+			client.remove_channels({channel})
+
 	def update_connections(self, connections):
 		"""Connections should be a set of (name, host, nick, oauth, channel)"""
 		connections = set(connections)
 		self.logger.debug("Updating streams={} to connections {}".format(self.streams, connections))
 		self.streams = {name: (host, nick, oauth, channel) for name, host, nick, oauth, channel in connections}
-		# group connections into {(host, nick, oauth): {channels}}
-		connections = {
-			(host, nick, oauth): set(channel for name, _, _, _, channel in items)
-			for (host, nick, oauth), items in groupby(connections,
-			                                          lambda (name, host, nick, oauth, channel): (host, nick, oauth))
-		}
-		for host, nick, oauth in set(connections.keys()) | set(self.clients.keys()):
-			if (host, nick, oauth) not in self.clients:
+		# group connections into {(host, nick, oauth, shard): {channels}}
+		grouped = defaultdict(set)
+		for name, host, nick, oauth, channel in connections:
+			grouped[host, nick, oauth, self._ring.get(channel)].add(channel)
+		connections = dict(grouped)
+		for key in set(connections.keys()) | set(self.clients.keys()):
+			host, nick, oauth, shard = key
+			if key not in self.clients:
 				# new connection
-				self.logger.info("Starting new irc client for {}@{}".format(nick, host))
-				self.clients[host, nick, oauth] = IRCClientManager(
-					host, nick, self._recv, channels=connections[host, nick, oauth],
-					password=oauth, twitch=True, logger=self.logger,
-				)
-				self.clients[host, nick, oauth].start()
-			elif (host, nick, oauth) in connections:
+				self._start_client(key, connections[key])
+			elif key in connections:
 				# existing connection
-				self.logger.debug("Updating channels for {}@{}".format(nick, host))
-				self.clients[host, nick, oauth].update_channels(connections[host, nick, oauth])
+				if self.clients[key].channels != connections[key]:
+					self.logger.warning("Channels for {}@{} client {} were out of sync: {} should be {}".format(
+						nick, host, shard, self.clients[key].channels, connections[key],
+					))
+				self.clients[key].update_channels(connections[key])
 			else:
 				# dead connection
-				client = self.clients.pop((host, nick, oauth))
-				self.logger.info("Client {}({}@{}) has no more connections, stopping".format(
-					client, nick, host
-				))
-				client.update_channels(set()) # by setting to no channels, ensures client won't call recv callback
-				self._stopping_clients.spawn(client.wait_and_stop)
+				self._stop_client(key)
 		assert set(self.clients.keys()) == set(connections.keys()), (
 			"Mismatch after syncing client managers: {!r} keys don't match {!r}".format(
 				self.clients, connections,
@@ -109,15 +202,26 @@ class IRCClientManager(HasLogger, GClient):
 	while preserving channel membership and re-enqueuing any messages we know were never sent
 	(so messages may still be lost, but it is less likely).
 	Takes a generic callback with args (irc_client_manager, msg) for all incoming PrivMsgs.
+	If recv_filter is given, it is called with (channel, text) first and messages it returns False for are dropped.
+	Outgoing messages are sent in priority order within twitch rate limits, see pipirc.ratelimit.
 	"""
 
-	def __init__(self, host, nick, callback, channels=None, logger=None, **irc_kwargs):
+	SEND_BATCH_SIZE = 100 # most messages to write at once
+
+	def __init__(self, host, nick, callback, limits, channels=None, recv_filter=None, logger=None, **irc_kwargs):
+		"""limits is the AccountLimits for nick, shared with any other clients for the same user"""
 		irc_kwargs.update(hostname=host, nick=nick)
 		self.recv_callback = callback
+		self.recv_filter = recv_filter
+		self.channel_dropped = defaultdict(lambda: 0) # {channel: num of messages dropped by recv_filter}
 		self.irc_kwargs = irc_kwargs
 
 		self.channels = set() if channels is None else channels
 		self.channel_pending = defaultdict(lambda: 0) # {channel: num of pending messages on queue}
+		self.limits = limits
+		self.scheduler = SendScheduler(limits, on_drop=self._on_drop)
+		self._join_queue = [] # channels waiting to be joined, see _join_loop()
+		self._join_waiter = Event()
 		self._client = AsyncResult()
 		self._recv_queue = Queue()
 
@@ -131,6 +235,8 @@ class IRCClientManager(HasLogger, GClient):
 
 	def _start(self):
 		self._client_loop_worker = self.group.spawn(self._client_loop)
+		self.group.spawn(self._send_loop)
+		self.group.spawn(self._join_loop)
 
 	def _client_loop(self):
 		try:
@@ -138,10 +244,12 @@ class IRCClientManager(HasLogger, GClient):
 			while True:
 				self.logger.info("Starting new irc connection")
 				client = girc.Client(**self.irc_kwargs)
-				self.logger.debug("Joining channels: {}".format(self.all_open_channels))
-				for channel in self.all_open_channels:
-					client.channel(channel).join()
+				self.logger.debug("Queueing join of channels: {}".format(self.all_open_channels))
+				self._join_queue = list(self.all_open_channels)
+				self._join_waiter.set()
 				client.handler(self._client_recv, command=girc.message.Privmsg)
+				client.handler(self._user_state, command='USERSTATE')
+				client.handler(self._room_state, command='ROOMSTATE')
 				self._client.set(client)
 				try:
 					client.start()
@@ -149,12 +257,14 @@ class IRCClientManager(HasLogger, GClient):
 					backoff.reset()
 					client.wait_for_stop()
 				except Exception as ex:
-					self.logger.warning("irc connection died, retrying in {}".format(backoff.peek()), exc_info=True)
+					# jitter the retry so many connections dropped at once don't all reconnect at once
+					delay = backoff.get() * random.uniform(0.5, 1)
+					self.logger.warning("irc connection died, retrying in {:.2f}".format(delay), exc_info=True)
 					# clear _client if no-one else has
 					if self._client.ready():
 						assert self._client.get() is client
 						self._client = AsyncResult()
-					gevent.sleep(backoff.get())
+					gevent.sleep(delay)
 				else:
 					self.logger.info("irc connection exited gracefully, stopping")
 					self.stop() # graceful exit
@@ -163,8 +273,45 @@ class IRCClientManager(HasLogger, GClient):
 			self.stop(ex)
 
 	def _client_recv(self, client, msg):
+		# fast path: drop anything we'd ignore before it's queued or we look at its tags
+		if msg.target not in self.channels:
+			self.logger.debug("Ignoring message {}, not a channel we care about".format(msg))
+			# ignore PMs and messages from channels we're only holding open while we finish sending
+			return
+		if self.recv_filter and not self.recv_filter(msg.target, msg.payload):
+			self.channel_dropped[msg.target] += 1
+			return
 		self._recv_queue.put(msg)
 
+	def _user_state(self, client, msg):
+		channel = msg.params[0]
+		self.limits.set_channel_state(channel, mod=msg.tags.get('mod') == '1')
+
+	def _room_state(self, client, msg):
+		# ROOMSTATE may only include the tags that changed
+		if 'slow' in msg.tags:
+			channel = msg.params[0]
+			self.limits.set_channel_state(channel, slow=int(msg.tags['slow']))
+
+	def _join_loop(self):
+		"""Join queued channels within twitch's join rate limit, so a reconnect or a big channel update
+		doesn't get us disconnected. Channels that are no longer wanted by the time we'd join them
+		don't count against the limit."""
+		while True:
+			self._join_waiter.wait()
+			self._join_waiter.clear()
+			while self._join_queue:
+				client = self.client
+				wait = self.limits.join_wait_time()
+				if wait:
+					gevent.sleep(wait)
+					continue # the queue may have changed while we waited
+				channel = self._join_queue.pop(0)
+				if channel not in self.all_open_channels:
+					continue # no longer wanted
+				self.limits.try_join() # can't fail, as we haven't yielded since checking
+				client.channel(channel).join()
+
 	@property
 	def client(self):
 		while True:
@@ -176,16 +323,17 @@ class IRCClientManager(HasLogger, GClient):
 			if self._client is waiter:
 				self._client = AsyncResult()
 
-	def send(self, channel, text):
+	def send(self, channel, text, priority='reply'):
+		# put() raises on a bad priority, so only count the message once it's queued
+		self.scheduler.put(channel, text, priority)
 		self.channel_pending[channel] += 1
-		self.logger.debug("Enqueuing message for channel {} ({} now pending): {!r}".format(
-			channel, self.channel_pending[channel], text
+		self.logger.debug("Enqueued {} message for channel {} ({} now pending): {!r}".format(
+			priority, channel, self.channel_pending[channel], text
 		))
-		super(IRCClientManager, self).send((channel, text))
 
 	def update_channels(self, new_channels):
 		old_channels = self.all_open_channels
-		self.channels = new_channels
+		self.channels = set(new_channels)
 		if not self._client.ready() or self._client.get()._stopping:
 			self.logger.debug("Ignoring channel resync, client not running")
 			return # no active connection, we're done
@@ -193,37 +341,59 @@ class IRCClientManager(HasLogger, GClient):
 		self.logger.debug("Updating channels: {} to {}".format(old_channels, self.all_open_channels))
 		for channel in old_channels - self.all_open_channels:
 			client.channel(channel).part()
-		for channel in new_channels - self.all_open_channels:
-			client.channel(channel).join()
-
-	def _send(self, msg):
-		if msg == 'stop':
-			self.logger.debug("Calling graceful stop due to stop message on queue")
-			self.stop() # does not return
-			assert False
-		channel, text = msg
+		self._join_queue += list(self.all_open_channels - old_channels)
+		self._join_waiter.set()
+
+	def add_channels(self, channels):
+		self.update_channels(self.channels | channels)
+
+	def remove_channels(self, channels):
+		self.update_channels(self.channels - channels)
+
+	def _send_loop(self):
+		while True:
+			batch = self.scheduler.get_batch(self.SEND_BATCH_SIZE)
+			try:
+				self._send(batch)
+			finally:
+				for msg in batch:
+					self.scheduler.done()
+
+	def _send(self, batch):
+		"""Send a list of (channel, text). All are put on the client's queue at once so they're written
+		back to back, and we only wait for the last one to be written."""
 		try:
-			girc.message.Privmsg(self.client, channel, text).send(block=True)
+			client = self.client
+			messages = [girc.message.Privmsg(client, channel, text) for channel, text in batch]
+			for message in messages[:-1]:
+				message.send()
+			messages[-1].send(block=True)
 		except Exception:
-			# we can't be certain the message wasn't sent, so discard it
+			# we can't be certain the messages weren't sent, so discard them
 			# but at least we know all remaining items in the queue have not been.
 			pass
 		finally:
-			self.channel_pending[channel] -= 1
-			self.logger.debug("Sent message for channel {} ({} now pending): {!r}".format(
-				channel, self.channel_pending[channel], text
-			))
-			if self.channel_pending[channel] <= 0:
-				del self.channel_pending[channel]
-				if self._client.ready() and channel not in self.all_open_channels:
-					self._client.get().channel(channel).part()
+			for channel, text in batch:
+				self.logger.debug("Sent message for channel {} ({} pending): {!r}".format(
+					channel, self.channel_pending[channel] - 1, text
+				))
+				self._message_done(channel)
+
+	def _on_drop(self, channel, text):
+		self.logger.warning("Dropping message for channel {} as it couldn't be sent in time: {!r}".format(channel, text))
+		self._message_done(channel)
+
+	def _message_done(self, channel):
+		self.channel_pending[channel] -= 1
+		if self.channel_pending[channel] <= 0:
+			del self.channel_pending[channel]
+			if self._client.ready() and channel not in self.all_open_channels:
+				self._client.get().channel(channel).part()
 
 	def _receive(self):
 		for msg in self._recv_queue:
 			if msg.target not in self.channels:
-				self.logger.debug("Ignoring message {}, not a channel we care about".format(msg))
-				# ignore PMs and messages from channels we're only holding open while we finish sending
-				return
+				continue # we left the channel while the message was queued
 			try:
 				self.recv_callback(self, msg)
 			except Exception:
@@ -231,11 +401,12 @@ class IRCClientManager(HasLogger, GClient):
 				pass
 
 	def wait_and_stop(self):
-		"""Graceful stop. Waits to send all remaining messages."""
-		self.logger.debug("Setting stop message for flushing send queue then stop")
-		super(IRCClientManager, self).send('stop')
-		self.wait_for_stop()
+		"""Graceful stop. Waits to send (or drop, if they can't be sent in time) all remaining messages."""
+		self.logger.debug("Waiting for send queue to flush, then stopping")
+		self.scheduler.join()
+		self.stop()
 
 	def _stop(self, ex):
+		self.scheduler.close()
 		if self._client.ready():
 			self._client.get().quit()
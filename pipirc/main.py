@@ -1,47 +1,115 @@
 
 import logging
 import multiprocessing
+import os
 import signal
+import socket
+import subprocess
+import sys
 
+import gevent
 import gevent.event
 
 from classtricks import HasLogger
 
+from . import handoff
 from .config import ServiceConfig
+from .gateway import IRCGateways
 from .ipc import IPCServer
 from .irc import IRCHostsManager
+from .pipkey import PipKeyIndex
 from .pipserver import PipConnectionServer
 
 
-def constant_time_equal(a, b):
-	"""Compare two strings in constant time (if they're the same length)"""
-	return len(a) == len(b) and sum(ord(c1) ^ ord(c2) for c1, c2 in zip(a, b)) == 0
-
-
 class Main(HasLogger):
 	"""Ties the main parts of the server together"""
-	def __init__(self, config, logger=None):
+
+	IRC_RESYNC_INTERVAL = 300 # how often to check irc channels match open streams, see sync_streams()
+	HANDOFF_ACK_TIMEOUT = 30 # how long a new master gets to confirm it has received our handoff
+
+	handed_off = False
+
+	def __init__(self, config, adopted=None, logger=None):
+		"""If adopted is given, it is the (state, fds) recieved from a previous master's handoff(),
+		and we take over its listeners, workers and streams."""
 		super(Main, self).__init__(logger=logger)
 		self.config = config
 		self.streams = self.config.streams # probably going to change this later
-		self.ipc_server = IPCServer(self, multiprocessing.cpu_count(), logger=self.logger)
-		self.irc_manager = IRCHostsManager(self.ipc_server.recv_chat, logger=self.logger)
-		self.pip_server = PipConnectionServer(self, self.config.listen, logger=self.logger)
-		self.pip_server.start()
+		self._pip_keys = PipKeyIndex(self.streams.values())
+		self.handed_off_event = gevent.event.Event()
+		listen = self.config.listen
+		if adopted:
+			state, fds = adopted
+			if state['pip_listener'] is not None:
+				listen = socket.fromfd(fds[state['pip_listener']], state['pip_family'], socket.SOCK_STREAM)
+		self.ipc_server = IPCServer(
+			self,
+			self.config.min_workers,
+			self.config.max_workers or multiprocessing.cpu_count(),
+			adopted=(state['ipc'], fds) if adopted else None,
+			logger=self.logger,
+		)
+		if adopted:
+			for fd in fds:
+				# fromfd() dups, so we're done with the originals
+				os.close(fd)
+		if self.config.irc_gateways:
+			self.irc_manager = IRCGateways(self, self.config.irc_gateways, logger=self.logger)
+		else:
+			self.irc_manager = IRCHostsManager(
+				self.ipc_server.recv_chat, self.config.irc_connections_per_user,
+				chat_filter=self.ipc_server.wants_chat, logger=self.logger,
+			)
+		if adopted:
+			self.sync_streams()
+		self._resync_loop = gevent.spawn(self._irc_resync_loop)
+		self.pip_server = None
+		if self.config.pip_reuseport:
+			self.logger.info("Workers will accept pip connections themselves")
+		else:
+			self.pip_server = PipConnectionServer(self, listen, logger=self.logger)
+			self.pip_server.start()
+		self._handoff_loop = None
+		if self.config.handoff_socket:
+			self._listen_for_handoff()
 		self.logger.debug("Initialized")
 
-	def send_chat(self, stream_name, text):
-		self.irc_manager.send(stream_name, text)
+	def send_chat(self, stream_name, text, priority='reply'):
+		self.irc_manager.send(stream_name, text, priority)
+
+	def _stream_irc_args(self, stream_config):
+		return (
+			stream_config.irc_host,
+			stream_config.irc_user,
+			stream_config.irc_oauth,
+			stream_config.irc_channel,
+		)
+
+	def stream_opened(self, stream_name):
+		"""Join chat for a stream. Safe to call for a stream that's already open (eg. after migrating)."""
+		stream_config = self.get_stream_config(stream_name)
+		if stream_config:
+			self.irc_manager.add_stream(stream_name, *self._stream_irc_args(stream_config))
+
+	def stream_closed(self, stream_name):
+		self.irc_manager.remove_stream(stream_name)
+
+	def chat_filter_changed(self, stream_name, chat_filter):
+		"""Called when a stream's ChatFilter is set, or removed (None)."""
+		# a local irc manager asks the ipc server directly, but gateways need to be told
+		if isinstance(self.irc_manager, IRCGateways):
+			self.irc_manager.set_chat_filter(stream_name, chat_filter)
+
+	def _irc_resync_loop(self):
+		while True:
+			gevent.sleep(self.IRC_RESYNC_INTERVAL)
+			self.sync_streams()
 
 	def sync_streams(self):
+		"""Fully resync irc channels with all open streams. stream_opened() and stream_closed()
+		keep them in sync as streams change, so this is only a periodic consistency check."""
 		self.irc_manager.update_connections(
-			(
-				stream_config.name,
-				stream_config.irc_host,
-				stream_config.irc_user,
-				stream_config.irc_oauth,
-				stream_config.irc_channel,
-			)
+			(stream_config.name,) + self._stream_irc_args(stream_config)
 			for stream_config in map(self.get_stream_config, self.ipc_server.streams)
 			if stream_config
 		)
@@ -54,28 +122,96 @@ class Main(HasLogger):
 		return self.streams[stream_name]
 
 	def is_stream_open(self, stream_name):
-		return stream_name in self.ipc_server.streams
+		return self.ipc_server.is_open(stream_name)
+
+	def claim_stream(self, stream_name):
+		"""Called by the pip server once a connection has authenticated as stream_name.
+		Returns False if it may not be opened as it is already open."""
+		return not self.is_stream_open(stream_name)
+
+	def release_stream(self, stream_name):
+		"""Called by the pip server if a connection fails between claim_stream() and open_stream()"""
+		# nothing to do, as we don't register the stream until open_stream()
+		pass
 
 	def get_stream_by_pip_key_constant_time(self, pip_key):
 		self.logger.debug("Trying to find stream for pip key")
-		# will probably change this later
-		streams = [
-			stream for stream in self.streams.values()
-			if constant_time_equal(stream.pip_key, pip_key)
-		]
-		if not streams:
+		stream = self._pip_keys.get(pip_key)
+		if not stream:
 			self.logger.debug("Key did not match")
 			return
-		assert len(streams) == 1
-		stream, = streams
 		self.logger.debug("Key matched stream: {}".format(stream))
 		return stream
 
+	def start_takeover(self):
+		"""Start a new master process, which will take over from us"""
+		if not self.config.handoff_socket:
+			self.logger.warning("Ignoring request to start new master, as handoff_socket is not configured")
+			return
+		self.logger.info("Starting new master to take over")
+		subprocess.Popen([sys.executable, '-m', 'pipirc', self.config.filepath, 'takeover'])
+
+	def _listen_for_handoff(self):
+		self._handoff_listener = handoff.listen(self.config.handoff_socket)
+		self._handoff_loop = gevent.spawn(self._accept_handoff)
+
+	def _accept_handoff(self):
+		sock, _ = self._handoff_listener.accept()
+		self._handoff_listener.close()
+		try:
+			self.handoff(sock)
+		except Exception:
+			self.logger.exception("Failed to hand off to new master, carrying on")
+			self._listen_for_handoff()
+		finally:
+			sock.close()
+
+	def handoff(self, sock):
+		"""Pass all our listeners, workers and streams to the new master connected on sock,
+		then shut down without disturbing them. We are unusable afterwards.
+		If the new master doesn't acknowledge the handoff, we carry on as before and raise."""
+		self.logger.info("Handing off to new master")
+		fds = []
+		if self.pip_server:
+			# dup the listener, as the pip server closes its own once we're done
+			pip_listener = self.pip_server.socket
+			fds.append(socket.fromfd(pip_listener.fileno(), pip_listener.family, socket.SOCK_STREAM))
+			state = dict(pip_listener=0, pip_family=pip_listener.family)
+			self.pip_server.stop_accepting()
+		else:
+			# workers own the listeners, and keep accepting throughout
+			state = dict(pip_listener=None, pip_family=None)
+		try:
+			state['ipc'] = self.ipc_server.hand_off(fds)
+			handoff.send_handoff(sock, state, fds)
+			handoff.wait_for_ack(sock, self.HANDOFF_ACK_TIMEOUT)
+		except Exception:
+			self.ipc_server.cancel_hand_off()
+			if self.pip_server:
+				self.pip_server.start_accepting()
+			raise
+		finally:
+			for fd in fds:
+				fd.close()
+		self.ipc_server.finish_hand_off()
+		if self.pip_server:
+			self.pip_server.stop()
+		self.logger.info("Handed off {} workers and {} streams".format(len(state['ipc']['conns']), len(state['ipc']['streams'])))
+		self.handed_off = True
+		self._resync_loop.kill(block=False)
+		# the new master makes its own irc connections, we only need to flush any remaining output
+		self.irc_manager.stop()
+		self.handed_off_event.set()
+
 	def stop(self):
 		self.logger.info("Gracefully shutting down")
+		self._resync_loop.kill(block=False)
+		if self._handoff_loop:
+			self._handoff_loop.kill(block=False)
 		# stop accepting new streams
-		self.pip_server.stop()
-		self.logger.debug("Pip server stopped")
+		if self.pip_server:
+			self.pip_server.stop()
+			self.logger.debug("Pip server stopped")
 		# close existing streams and stop workers
 		self.ipc_server.stop()
 		self.logger.debug("IPC stopped")
@@ -84,7 +220,8 @@ class Main(HasLogger):
 		self.logger.debug("IRC stopped")
 
 
-def main(conf_path, *args):
+def main(conf_path, mode=None):
+	"""If mode is "takeover", take over from a running master via the configured handoff_socket"""
 
 	logger = logging.getLogger("pipirc")
 
@@ -93,14 +230,26 @@ def main(conf_path, *args):
 
 	logger.info("Starting")
 
+	adopted = None
+	if mode == 'takeover':
+		logger.info("Taking over from running master at {}".format(config.handoff_socket))
+		adopted = handoff.recv_handoff(config.handoff_socket)
+	elif mode is not None:
+		raise ValueError("Unknown mode: {!r}".format(mode))
+
 	stop = gevent.event.Event()
 	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
 
-	main = Main(config, logger=logger)
+	main = Main(config, adopted=adopted, logger=logger)
+	signal.signal(signal.SIGUSR2, lambda signum, frame: gevent.spawn(main.start_takeover))
+	main.handed_off_event.rawlink(lambda event: stop.set())
 	logger.info("Started")
 	try:
 		stop.wait()
 	except KeyboardInterrupt:
 		pass
+	if main.handed_off:
+		logger.info("Exiting after handoff")
+		return
 	main.stop()
 	logger.info("Exiting cleanly")
@@ -0,0 +1,39 @@
+
+import hashlib
+import hmac
+import os
+
+
+def constant_time_equal(a, b):
+	"""Compare two strings in constant time (if they're the same length)"""
+	return len(a) == len(b) and sum(ord(c1) ^ ord(c2) for c1, c2 in zip(a, b)) == 0
+
+
+class PipKeyIndex(object):
+	"""Finds the stream for a pip key in constant time, without comparing against every stream's key.
+	Streams are indexed by an HMAC of their key under a secret generated at startup. As an attacker can't
+	compute the HMAC, how long the lookup takes reveals nothing useful about any key, and a match is
+	finally confirmed with a single constant-time comparison."""
+
+	def __init__(self, streams):
+		"""streams is an iterable of objects with a pip_key attribute"""
+		self._secret = os.urandom(32)
+		self._index = {}
+		for stream in streams:
+			digest = self._digest(stream.pip_key)
+			if digest in self._index:
+				raise ValueError("Streams {} and {} have the same pip key".format(self._index[digest], stream))
+			self._index[digest] = stream
+
+	def _digest(self, pip_key):
+		if isinstance(pip_key, unicode):
+			pip_key = pip_key.encode('utf-8')
+		return hmac.new(self._secret, pip_key, hashlib.sha256).digest()
+
+	def get(self, pip_key):
+		"""Returns the stream with given pip key, or None"""
+		stream = self._index.get(self._digest(pip_key))
+		if stream is None or not constant_time_equal(stream.pip_key, pip_key):
+			return None
+		return stream
+
@@ -1,8 +1,15 @@
 
+from collections import OrderedDict
+import time
+
+from gevent.pool import Pool
 from gevent.server import StreamServer
+import gevent
 
 from classtricks import HasLogger
 
+from .ratelimit import TokenBucket
+
 
 def recv_all(sock, length):
 	"""recv exactly length bytes from (blocking) sock, unless closed first"""
@@ -18,16 +25,72 @@ def recv_all(sock, length):
 class PipConnectionServer(HasLogger, StreamServer):
 	"""A socket server that accepts connections from a special client,
 	does authentication and hands off the socket to main.
+	To protect the master from slow, idle or excessive clients (eg. everyone reconnecting after an outage),
+	handshakes must complete within a deadline, only a limited number may be in progress at once
+	(further connections wait in the listen backlog), and each IP address is rate limited.
 	"""
 	# TODO SSL
 
 	TOKEN_LENGTH = 32
+	MAX_TRACKED_IPS = 10000 # beyond this, the least recently seen IPs are forgotten
 
 	def __init__(self, main, listener, logger=None):
-		"""listener can be anything that looks like a listen socket or an address
+		"""main is the master's Main, or with pip_reuseport the worker's IPCWorkerConnection,
+		and must provide config, get_stream_by_pip_key_constant_time(), claim_stream(), release_stream()
+		and open_stream().
+		listener can be anything that looks like a listen socket or an address
 		parsable by gevent.baseserver.parse_address (eg. (host, port))"""
 		self.main = main
-		super(PipConnectionServer, self).__init__(listener, logger=logger)
+		config = main.config
+		self.handshake_timeout = config.pip_handshake_timeout
+		self.connects_per_ip = config.pip_connects_per_ip
+		self._ip_buckets = OrderedDict() # {ip: TokenBucket}, least recently seen first
+		self.stats = {
+			'accepted': 0,
+			'opened': 0,
+			'rejected_rate_limit': 0,
+			'rejected_unknown_key': 0,
+			'rejected_already_open': 0,
+			'timeouts': 0,
+			'errors': 0,
+			'total_handshake_time': 0.0, # of completed handshakes
+			'max_handshake_time': 0.0,
+		}
+		super(PipConnectionServer, self).__init__(
+			listener, backlog=config.pip_listen_backlog, spawn=Pool(config.pip_max_handshakes), logger=logger,
+		)
+
+	@property
+	def handshakes_in_progress(self):
+		return len(self.pool)
+
+	def _rate_limited(self, ip):
+		"""Returns True if ip has connected too often recently, otherwise counts this connection"""
+		if not self.connects_per_ip:
+			return False
+		now = time.time()
+		bucket = self._ip_buckets.pop(ip, None)
+		if bucket is None:
+			if len(self._ip_buckets) >= self.MAX_TRACKED_IPS:
+				self._ip_buckets.popitem(last=False)
+			# allow the full configured count as a burst, unlike TokenBucket.for_limit()
+			count, period = self.connects_per_ip
+			bucket = TokenBucket(count, count / float(period))
+		# re-insert to mark it as most recently seen
+		self._ip_buckets[ip] = bucket
+		if bucket.wait_time(now):
+			return True
+		bucket.take(now)
+		return False
+
+	def _release(self, stream):
+		"""Give up a stream we claimed but failed to open"""
+		if stream is None:
+			return
+		try:
+			self.main.release_stream(stream.name)
+		except Exception:
+			self.logger.exception("Failed to release stream {}".format(stream))
 
 	def do_close(self, *args):
 		# We don't want to close the connection after handle returns, we want to wait until all references are gone
@@ -41,25 +104,61 @@ class PipConnectionServer(HasLogger, StreamServer):
 		#   "OK": The connection can continue, switch to pip protocol data
 		#   otherwise: A human readable error message. The connection will then close.
 		self.logger.debug("Accepting new connection fd {} from address {}".format(sock.fileno(), address))
+		self.stats['accepted'] += 1
+		started = time.time()
+		if self._rate_limited(address[0]):
+			self.stats['rejected_rate_limit'] += 1
+			self.logger.info("Rejecting connection from {}: too many recent connections".format(address))
+			try:
+				with gevent.Timeout(self.handshake_timeout):
+					sock.sendall("Too many connection attempts. Please wait a minute and try again.\n")
+			except (gevent.Timeout, Exception):
+				pass
+			sock.close()
+			return
+		claimed = None # stream to release if we fail after claiming it
 		try:
-			pip_key = recv_all(sock, self.TOKEN_LENGTH)
-			# for security, some care must be taken here to be constant-time
-			stream = self.main.get_stream_by_pip_key_constant_time(pip_key)
-			if not stream:
-				sock.sendall("Unknown pip key.\n")
-				return
-			if self.main.is_stream_open(stream):
-				sock.sendall(
-					"You appear to already be connected.\n"
-					"It's possible this is a zombie connection and will disappear soon.\n"
-					"Close any other copies of this program, or just try again in a few seconds.\n"
-				)
-				return
-			sock.sendall("OK\n")
+			with gevent.Timeout(self.handshake_timeout):
+				pip_key = recv_all(sock, self.TOKEN_LENGTH)
+				# for security, some care must be taken here to be constant-time
+				stream = self.main.get_stream_by_pip_key_constant_time(pip_key)
+				if not stream:
+					self.stats['rejected_unknown_key'] += 1
+					sock.sendall("Unknown pip key.\n")
+					sock.close()
+					return
+				if not self.main.claim_stream(stream.name):
+					self.stats['rejected_already_open'] += 1
+					sock.sendall(
+						"You appear to already be connected.\n"
+						"It's possible this is a zombie connection and will disappear soon.\n"
+						"Close any other copies of this program, or just try again in a few seconds.\n"
+					)
+					sock.close()
+					return
+				claimed = stream
+				sock.sendall("OK\n")
+		except gevent.Timeout:
+			self.stats['timeouts'] += 1
+			self.logger.info("Handshake from address {} timed out".format(address))
+			self._release(claimed)
+			sock.close()
+			return
 		except Exception:
+			self.stats['errors'] += 1
 			self.logger.exception("Error in pip_key handshake from address {}".format(address))
-			sock.sendall("Internal server error! We'll get this fixed soon.\n")
+			self._release(claimed)
+			try:
+				with gevent.Timeout(self.handshake_timeout):
+					sock.sendall("Internal server error! We'll get this fixed soon.\n")
+			except (gevent.Timeout, Exception):
+				pass
+			sock.close()
 			return
+		handshake_time = time.time() - started
+		self.stats['opened'] += 1
+		self.stats['total_handshake_time'] += handshake_time
+		self.stats['max_handshake_time'] = max(self.stats['max_handshake_time'], handshake_time)
 		try:
 			self.main.open_stream(stream, sock)
 		except Exception:
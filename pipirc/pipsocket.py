@@ -0,0 +1,109 @@
+
+"""A wrapper around a pip connection's socket which lets a bot hand the connection off to another process
+(see PippyBot.quiesce()) without relying on the internals of the pip client (gpippy) reading from it.
+
+Pip protocol messages are framed as a 4-byte little-endian payload length, a 1-byte message type, then the payload.
+By tracking this framing, the wrapper never lets a read run past the end of a message, so the client can't have
+read ahead into a message it hasn't processed, and it knows when the client is blocked waiting for a new message.
+Once detached, no further data is passed to the client, any that it had already been waiting on is kept to be
+handed off with the connection, and closing the wrapper never shuts down the connection.
+
+We still assume the client reads with recv() and processes each message (including calling on_update)
+before reading the next, and that its pipdata may be replaced before it has read anything (see PippyBot).
+"""
+
+import errno
+import socket
+import struct
+
+import gevent
+import gevent.event
+
+
+HEADER = struct.Struct('<IB') # payload length, message type
+
+
+class PipSocket(object):
+	detached = False
+	before_read = None # if set, called (once) when data is waiting, before any is read from the connection
+
+	def __init__(self, sock, unread=''):
+		"""unread is data already recieved from sock by a previous owner, which must be read first"""
+		self._sock = sock
+		self.unread = unread
+		self._header = '' # header of the current message so far
+		self._remaining = 0 # bytes of the current message's payload not yet read
+		self._reader = None # greenlet currently blocked in recv(), if any
+		self._not_reading = gevent.event.Event()
+		self._not_reading.set()
+		self.idle = False # whether the reader is waiting for the start of a new message
+		self.became_idle = gevent.event.Event() # set while idle
+
+	def __getattr__(self, attr):
+		return getattr(self._sock, attr)
+
+	@property
+	def at_boundary(self):
+		"""Whether everything read so far is complete messages"""
+		return not self._header and not self._remaining
+
+	def _limit(self, size):
+		if self._remaining:
+			return min(size, self._remaining)
+		return min(size, HEADER.size - len(self._header))
+
+	def _consume(self, data):
+		if self._remaining:
+			self._remaining -= len(data)
+			return
+		self._header += data
+		if len(self._header) == HEADER.size:
+			self._remaining, message_type = HEADER.unpack(self._header)
+			self._header = ''
+
+	def recv(self, size, *flags):
+		if self.detached:
+			raise socket.error(errno.EBADF, "Pip connection has been handed off")
+		size = self._limit(size)
+		if self.unread:
+			data, self.unread = self.unread[:size], self.unread[size:]
+			self._consume(data)
+			return data
+		self._reader = gevent.getcurrent()
+		self._not_reading.clear()
+		self.idle = self.at_boundary
+		if self.idle:
+			self.became_idle.set()
+		try:
+			if self.before_read is not None:
+				# wait for data without taking any, so the hook runs before anything is read
+				self._sock.recv(1, socket.MSG_PEEK)
+				hook, self.before_read = self.before_read, None
+				hook()
+			data = self._sock.recv(size, *flags)
+		finally:
+			self.idle = False
+			self.became_idle.clear()
+			self._reader = None
+			self._not_reading.set()
+		if self.detached:
+			# we were detached while waiting, this belongs to whoever takes over the connection
+			self.unread += data
+			raise socket.error(errno.EBADF, "Pip connection has been handed off")
+		self._consume(data)
+		return data
+
+	def detach(self):
+		"""Stop passing data to the reader, which must be idle (see idle) or not reading.
+		Blocks until any reader waiting in recv() has stopped. Afterwards unread holds any data
+		that must be passed along with the connection, and closing us doesn't affect the connection."""
+		assert self.at_boundary, "Can't detach pip socket part-way through a message"
+		self.detached = True
+		if self._reader is not None:
+			gevent.kill(self._reader)
+			self._not_reading.wait()
+
+	def shutdown(self, how):
+		if not self.detached:
+			self._sock.shutdown(how)
+
@@ -0,0 +1,68 @@
+
+"""Policies for choosing which worker a new stream should be placed on.
+
+A policy is a callable taking a list of IPCMasterConnections and returning the one to use.
+Each conn has a set of streams, and a dict load of the most recent load sample reported by the worker,
+which is empty until the first report arrives. See IPCWorkerConnection.sample_load() for its keys.
+"""
+
+import random
+
+
+def least_streams(conns):
+	"""Approximate least loaded as least streams"""
+	return min(conns, key=lambda conn: len(conn.streams))
+
+
+def least_cpu(conns):
+	"""Least cpu usage, ties broken by least streams"""
+	return min(conns, key=lambda conn: (conn.load.get('cpu', 0), len(conn.streams)))
+
+
+class Weighted(object):
+	"""Lowest score, where the score is a weighted sum of the latest load sample and stream count.
+	The stream count term means a burst of new streams are spread out even before the next load sample."""
+
+	WEIGHTS = {
+		'cpu': 1.0, # fraction of one core
+		'pip_update_rate': 0.001, # updates per second
+		'greenlets': 0.0001,
+		'rss': 0.1 / 2**30, # bytes
+		'streams': 0.05,
+	}
+
+	def __init__(self, **weights):
+		self.weights = self.WEIGHTS.copy()
+		self.weights.update(weights)
+
+	def score(self, conn):
+		score = self.weights['streams'] * len(conn.streams)
+		for key, weight in self.weights.items():
+			if key in conn.load:
+				score += weight * conn.load[key]
+		return score
+
+	def __call__(self, conns):
+		return min(conns, key=self.score)
+
+
+class PowerOfTwoChoices(object):
+	"""Pick two conns at random and take the lower scoring of the two, according to the Weighted policy.
+	Avoids every new stream going to the same conn when load samples are stale."""
+
+	def __init__(self, **weights):
+		self.weighted = Weighted(**weights)
+
+	def __call__(self, conns):
+		if len(conns) <= 2:
+			return self.weighted(conns)
+		return self.weighted(random.sample(conns, 2))
+
+
+POLICIES = {
+	'least_streams': least_streams,
+	'least_cpu': least_cpu,
+	'weighted': Weighted(),
+	'power_of_two': PowerOfTwoChoices(),
+}
+
@@ -0,0 +1,240 @@
+
+"""Scheduling of outgoing chat so we stay within twitch's rate limits.
+
+Twitch limits each account to 20 messages per 30 seconds, or 100 per 30 seconds in channels
+where it is a moderator, and exceeding this gets the account muted globally for some time.
+Channels in slow mode additionally limit non-moderators to one message per slow mode period.
+Joining channels is separately limited to 20 per 10 seconds.
+"""
+
+import time
+
+from gevent.event import Event
+
+
+PRIORITIES = ['reply', 'error', 'debug'] # highest priority first
+
+
+class TokenBucket(object):
+	"""Allows bursts of up to capacity, refilling at rate tokens per second."""
+
+	def __init__(self, capacity, rate):
+		self.capacity = capacity
+		self.rate = rate
+		self.tokens = capacity
+		self.updated = time.time()
+
+	@classmethod
+	def for_limit(cls, count, period):
+		"""A bucket which never allows more than count in any sliding window of period seconds.
+		Half of count is available as burst and the rest is spread over the period,
+		as burst + rate * period must not exceed count."""
+		return cls(count / 2., count / 2. / period)
+
+	def _refill(self, now):
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def wait_time(self, now):
+		"""Seconds until a token is available"""
+		self._refill(now)
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+
+	def take(self, now):
+		self._refill(now)
+		self.tokens -= 1
+
+
+class AccountLimits(object):
+	"""The rate limit state of one twitch account, shared by all connections using that account."""
+
+	ACCOUNT_LIMIT = 20, 30 # messages, seconds
+	MOD_ACCOUNT_LIMIT = 100, 30
+	JOIN_LIMIT = 20, 10
+
+	def __init__(self, nick):
+		self.nick = nick
+		# Any message counts against the mod limit, and messages in non-mod channels count against
+		# the lower limit as well.
+		self._mod_bucket = TokenBucket.for_limit(*self.MOD_ACCOUNT_LIMIT)
+		self._bucket = TokenBucket.for_limit(*self.ACCOUNT_LIMIT)
+		self._join_bucket = TokenBucket.for_limit(*self.JOIN_LIMIT)
+		self._channel_buckets = {} # {channel: TokenBucket}, only for channels in slow mode
+		self.moderated = set() # channels we are a moderator in
+		self.schedulers = set() # SendSchedulers to notify of changes
+
+	def is_mod(self, channel):
+		return channel in self.moderated or channel.lstrip('#').lower() == self.nick.lower()
+
+	def set_channel_state(self, channel, mod=None, slow=None):
+		"""Update what we know about a channel, from twitch USERSTATE (mod) or ROOMSTATE (slow) tags.
+		slow is the slow mode period in seconds, 0 for off."""
+		if mod is not None:
+			if mod:
+				self.moderated.add(channel)
+			else:
+				self.moderated.discard(channel)
+		if slow is not None:
+			if slow:
+				self._channel_buckets[channel] = TokenBucket(1, 1. / slow)
+			else:
+				self._channel_buckets.pop(channel, None)
+		for scheduler in self.schedulers:
+			scheduler.changed()
+
+	def wait_time(self, channel, now):
+		"""Seconds until a message may be sent to channel"""
+		buckets = [self._mod_bucket]
+		if not self.is_mod(channel):
+			buckets.append(self._bucket)
+			if channel in self._channel_buckets:
+				buckets.append(self._channel_buckets[channel])
+		return max(bucket.wait_time(now) for bucket in buckets)
+
+	def take(self, channel, now):
+		"""Record a message being sent to channel"""
+		self._mod_bucket.take(now)
+		if not self.is_mod(channel):
+			self._bucket.take(now)
+			if channel in self._channel_buckets:
+				self._channel_buckets[channel].take(now)
+
+	def join_wait_time(self):
+		"""Returns how long until we may join a channel, or 0 if we may now"""
+		return self._join_bucket.wait_time(time.time())
+
+	def try_join(self):
+		"""If we may join a channel now, record it as joined and return True. Otherwise return False."""
+		now = time.time()
+		if self._join_bucket.wait_time(now):
+			return False
+		self._join_bucket.take(now)
+		return True
+
+
+class SendScheduler(object):
+	"""Orders outgoing messages for one twitch connection by priority (see PRIORITIES),
+	holding each until the account's rate limits (see AccountLimits) allow it to be sent.
+	A message for a rate-limited channel doesn't hold up messages for other channels.
+	Messages still unsent after MAX_AGE[priority] seconds are dropped, as a late reply is
+	worse than none, and a backlog would otherwise delay every message after it.
+	"""
+
+	MAX_AGE = {
+		'reply': 60,
+		'error': 30,
+		'debug': 10,
+	}
+
+	def __init__(self, limits, on_drop=None):
+		"""on_drop is called with (channel, text) for each message dropped without being sent"""
+		self.limits = limits
+		self.limits.schedulers.add(self)
+		self.on_drop = on_drop
+		self.queues = {priority: [] for priority in PRIORITIES} # {priority: [(channel, text, enqueued, deadline)]}
+		self._changed = Event() # set when a message is queued or channel state changes
+		self._idle = Event() # set when there are no queued or unfinished messages
+		self._idle.set()
+		self._unfinished = 0
+		# metrics
+		self.sent = 0
+		self.dropped = 0
+		self.total_wait = 0
+		self.max_wait = 0
+
+	@property
+	def depth(self):
+		"""{priority: number of queued messages}"""
+		return {priority: len(queue) for priority, queue in self.queues.items()}
+
+	@property
+	def mean_wait(self):
+		return self.total_wait / self.sent if self.sent else 0
+
+	def put(self, channel, text, priority='reply'):
+		if priority not in self.queues:
+			raise ValueError("Unknown message priority: {!r}".format(priority))
+		now = time.time()
+		self.queues[priority].append((channel, text, now, now + self.MAX_AGE[priority]))
+		self._unfinished += 1
+		self._idle.clear()
+		self._changed.set()
+
+	def changed(self):
+		"""Wake up get(), as what can be sent may have changed"""
+		self._changed.set()
+
+	def close(self):
+		self.limits.schedulers.discard(self)
+
+	def _drop(self, channel, text):
+		self.dropped += 1
+		self.done()
+		if self.on_drop:
+			self.on_drop(channel, text)
+
+	def _next(self):
+		"""Pop and return the next sendable (channel, text, enqueued), or return the time to wait
+		before trying again (None to wait for a change)"""
+		now = time.time()
+		min_wait = None
+		for priority in PRIORITIES:
+			queue = self.queues[priority]
+			blocked = set() # channels we already can't send for, so later messages keep their order
+			for index, (channel, text, enqueued, deadline) in enumerate(queue):
+				if deadline < now:
+					queue.pop(index)
+					self._drop(channel, text)
+					return 0 # our indexes are invalid now, start again
+				if channel in blocked:
+					continue
+				wait = self.limits.wait_time(channel, now)
+				if not wait:
+					queue.pop(index)
+					self.limits.take(channel, now)
+					return channel, text, enqueued
+				blocked.add(channel)
+				min_wait = wait if min_wait is None else min(wait, min_wait)
+		return min_wait
+
+	def _sent(self, channel, text, enqueued):
+		wait = time.time() - enqueued
+		self.sent += 1
+		self.total_wait += wait
+		self.max_wait = max(self.max_wait, wait)
+		return channel, text
+
+	def get(self):
+		"""Block until a message may be sent, and return (channel, text).
+		The caller must call done() once it has finished with the message."""
+		while True:
+			self._changed.clear()
+			result = self._next()
+			if isinstance(result, tuple):
+				return self._sent(*result)
+			if result != 0:
+				self._changed.wait(result)
+
+	def get_batch(self, limit):
+		"""As get(), but returns a list of up to limit messages, of all those which may be sent right now.
+		The caller must call done() for each message."""
+		batch = [self.get()]
+		while len(batch) < limit:
+			result = self._next()
+			if isinstance(result, tuple):
+				batch.append(self._sent(*result))
+			elif result != 0:
+				break
+		return batch
+
+	def done(self):
+		self._unfinished -= 1
+		if not self._unfinished:
+			self._idle.set()
+
+	def join(self):
+		"""Wait until all queued messages have been sent or dropped"""
+		self._idle.wait()
+
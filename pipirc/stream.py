@@ -29,6 +29,11 @@ class Stream(object):
 			'If you have commands that cost channel currency, this is the name of the currency for use in help messages.',
 		'debug':
 			'Set True for extra status messages to be sent to IRC.',
+		'coalesce_chat':
+			'When true, lines of bot output sent in quick succession (eg. the lines of a command\'s response) '
+			'are joined into as few chat messages as possible, seperated by " | ". The first line is sent straight away '
+			'and any that follow it within 0.2s are joined. This makes multi-line responses '
+			'arrive much faster. Set false to always send each line as its own message.',
 		'deepbot_url':
 			'When set, enable integration with a deepbot instance at given url. You must also set deepbot_secret. '
 			'This enables the ability for commands to cost points, and without it all point costs are ignored.',
@@ -42,6 +47,7 @@ class Stream(object):
 		'irc_oauth': None,
 		'command_prefix': '!',
 		'debug': False,
+		'coalesce_chat': True,
 		'currency': 'points',
 		'deepbot_url': None,
 		'deepbot_secret': None,
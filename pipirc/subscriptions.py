@@ -0,0 +1,82 @@
+
+"""Dispatch of pip updates to only the feature callbacks that care about what changed.
+
+Callbacks subscribe with @on_update(paths=[...]) (see pipirc.feature), where each path is either a dotted string
+of keys from the root of the pip data, eg. 'Map.CurrCell', or a predicate taking an updated value.
+A string path matches an update to a value anywhere under it, or to any value above it
+(as replacing a parent may change everything below it).
+"""
+
+
+def parse_path(path):
+	"""'Map.CurrCell' -> ('Map', 'CurrCell')"""
+	return tuple(path.split('.')) if path else ()
+
+
+def value_path(value):
+	"""Returns the path of keys from the root to an updated pip value, as per parse_path()"""
+	path = []
+	try:
+		while value.parent is not None:
+			path.append(str(value.key))
+			value = value.parent
+	except AttributeError:
+		# a value we can't place is assumed to touch everything
+		return ()
+	return tuple(reversed(path))
+
+
+class PathNode(object):
+	def __init__(self):
+		self.children = {} # {key: PathNode}
+		self.subscribers = [] # subscribers to this exact path
+
+
+class UpdateSubscriptions(object):
+	"""Index of which subscribers (any hashable, eg. (feature, callback)) want which pip updates"""
+
+	def __init__(self):
+		self._root = PathNode()
+		self._always = [] # subscribers to all updates
+		self._predicates = [] # [(predicate, subscriber)]
+
+	def add(self, subscriber, paths=None):
+		"""Subscribe to updates under any of paths, or to all updates if paths is None"""
+		if paths is None:
+			self._always.append(subscriber)
+			return
+		for path in paths:
+			if callable(path):
+				self._predicates.append((path, subscriber))
+				continue
+			node = self._root
+			for key in parse_path(path):
+				node = node.children.setdefault(key, PathNode())
+			node.subscribers.append(subscriber)
+
+	def _subtree(self, node, matched):
+		matched.update(node.subscribers)
+		for child in node.children.values():
+			self._subtree(child, matched)
+
+	def match(self, updates):
+		"""Returns the set of subscribers that want this list of updated values"""
+		matched = set(self._always)
+		if not self._root.children and not self._root.subscribers and not self._predicates:
+			return matched # nothing to match against, don't bother placing the values
+		for value in updates:
+			node = self._root
+			matched.update(node.subscribers)
+			for key in value_path(value):
+				node = node.children.get(key)
+				if node is None:
+					break
+				matched.update(node.subscribers)
+			else:
+				# the value is at or above these subscriptions
+				self._subtree(node, matched)
+		for predicate, subscriber in self._predicates:
+			if subscriber not in matched and any(predicate(value) for value in updates):
+				matched.add(subscriber)
+		return matched
+
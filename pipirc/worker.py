@@ -22,6 +22,12 @@ def main(conf_path, sock_path):
 	config = ServiceConfig(conf_path)
 	config.configure_logging()
 
+	run(config, sock_path)
+
+
+def run(config, sock_path):
+	"""Run a worker with already-loaded config until it stops"""
+
 	name = "{}:{}".format(os.getpid(), uuid4())
 	logger = logging.getLogger('pipirc.worker').getChild(name)
 
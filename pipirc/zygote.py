@@ -0,0 +1,192 @@
+
+from collections import deque
+from subprocess import PIPE
+import logging
+import os
+import random
+import subprocess
+import sys
+
+from gevent.event import AsyncResult
+from gevent.fileobject import FileObject
+from gevent.pool import Group
+from gevent.queue import Queue
+import gevent
+
+from classtricks import HasLogger
+
+from .config import ServiceConfig
+
+
+class Zygote(HasLogger):
+	"""Master-side handle on a zygote process.
+	The zygote loads all worker code and config once, then forks new workers on request,
+	which is much faster than starting a fresh python process.
+	It can also keep some number of spare workers forked ahead of time, waiting to be started.
+
+	We talk to the zygote with a simple line-based protocol over its stdin/stdout:
+		master sends "spawn", zygote replies "spawned PID" once worker PID has been started
+		zygote sends "exited PID CODE" when a worker exits, with CODE as per Popen.returncode
+	Closing its stdin tells the zygote to exit.
+	"""
+
+	def __init__(self, conf_path, sock_path, spares=0, logger=None):
+		super(Zygote, self).__init__(logger=logger)
+		self.proc = subprocess.Popen([
+			sys.executable,
+			'-m', 'pipirc', 'zygote',
+			conf_path, sock_path, str(spares),
+		], stdin=PIPE, stdout=PIPE)
+		self._spawn_waiters = deque() # AsyncResults for spawn requests, answered in order
+		self._exits = {} # {pid: AsyncResult of exit code}
+		self._reader = gevent.spawn(self._read_loop)
+
+	@property
+	def running(self):
+		return not self._reader.ready()
+
+	def _read_loop(self):
+		try:
+			for line in self.proc.stdout:
+				parts = line.split()
+				if parts[0] == 'spawned':
+					pid = int(parts[1])
+					self._spawn_waiters.popleft().set(pid)
+				elif parts[0] == 'exited':
+					pid, code = map(int, parts[1:])
+					self._exit_result(pid).set(code)
+				else:
+					self.logger.warning("Unknown message from zygote: {!r}".format(line))
+		except Exception:
+			self.logger.exception("Error reading from zygote")
+		ex = Exception("Zygote process exited")
+		self.logger.error("Zygote exited with code {}, falling back to starting workers as subprocesses".format(
+			self.proc.wait(),
+		))
+		for waiter in list(self._spawn_waiters) + self._exits.values():
+			if not waiter.ready():
+				waiter.set_exception(ex)
+
+	def _exit_result(self, pid):
+		if pid not in self._exits:
+			self._exits[pid] = AsyncResult()
+		return self._exits[pid]
+
+	def spawn(self):
+		"""Start a new worker, returning its pid"""
+		if not self.running:
+			raise Exception("Zygote process is not running")
+		waiter = AsyncResult()
+		self._spawn_waiters.append(waiter)
+		self.proc.stdin.write('spawn\n')
+		self.proc.stdin.flush()
+		return waiter.get()
+
+	def wait(self, pid):
+		"""Wait for worker with given pid to exit, returning its exit code"""
+		try:
+			return self._exit_result(pid).get()
+		finally:
+			if self._exits[pid].ready():
+				del self._exits[pid]
+
+	def stop(self):
+		"""Stop the zygote. Running workers are not affected."""
+		self.proc.stdin.close()
+		self._reader.join()
+
+
+def main(conf_path, sock_path, spares):
+	"""Entry point for the zygote process"""
+	# Everything a worker needs is imported here, so that forked workers don't need to.
+	# This includes gevent, gpippy, mrpippy, and all features (and their dependencies, eg. requests).
+	# It isn't done at module level as the master imports this module too.
+	from . import worker
+
+	spares = int(spares)
+
+	config = ServiceConfig(conf_path)
+	config.configure_logging()
+
+	logger = logging.getLogger('pipirc.zygote')
+	output = FileObject(sys.stdout, 'w')
+	idle = deque() # [(pid, go fd)] of spare workers waiting to be started
+	# Only the main greenlet may fork, as it's the only one that keeps running in the child.
+	# Everything else runs in the group and gets killed in the child.
+	requests = Queue()
+	group = Group()
+
+	def report(line):
+		output.write(line + '\n')
+		output.flush()
+
+	def read_requests():
+		for line in FileObject(sys.stdin, 'r'):
+			requests.put(line.strip())
+		requests.put(StopIteration)
+
+	def fork_worker():
+		"""Fork a new worker, which waits until a byte is written to the returned go fd before starting"""
+		go_read, go_write = os.pipe()
+		pid = gevent.fork()
+		if pid == 0:
+			# child
+			try:
+				# otherwise every worker would generate the same random numbers as the zygote and each other
+				random.seed()
+				group.kill(block=False)
+				os.close(go_write)
+				for go_fd in [go_fd for idle_pid, go_fd in idle]:
+					os.close(go_fd)
+				devnull = os.open(os.devnull, os.O_RDWR)
+				os.dup2(devnull, 0)
+				os.dup2(devnull, 1)
+				if not os.read(go_read, 1):
+					os._exit(0) # zygote went away without starting us
+				os.close(go_read)
+				worker.run(config, sock_path)
+			except BaseException:
+				logger.exception("Fatal error in forked worker")
+				os._exit(1)
+			os._exit(0)
+		os.close(go_read)
+		group.spawn(reap, pid)
+		return pid, go_write
+
+	def reap(pid):
+		_, status = os.waitpid(pid, 0)
+		code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+		spare = next((item for item in idle if item[0] == pid), None)
+		if spare:
+			logger.warning("Spare worker {} exited with code {} before being used".format(pid, code))
+			idle.remove(spare)
+			os.close(spare[1])
+			requests.put('fill')
+			return
+		report('exited {} {}'.format(pid, code))
+
+	def fill_spares():
+		while len(idle) < spares:
+			idle.append(fork_worker())
+
+	def start_worker():
+		pid, go_fd = idle.popleft() if idle else fork_worker()
+		os.write(go_fd, 'x')
+		os.close(go_fd)
+		report('spawned {}'.format(pid))
+		fill_spares()
+
+	group.spawn(read_requests)
+	fill_spares()
+	logger.info("Zygote ready")
+	for request in requests:
+		if request == 'spawn':
+			start_worker()
+		elif request == 'fill':
+			fill_spares()
+		else:
+			logger.warning("Unknown request: {!r}".format(request))
+	# stdin closed, time to go. closing the go fds of our spares tells them to exit.
+	logger.info("Zygote stopping")
+	for pid, go_fd in idle:
+		os.close(go_fd)